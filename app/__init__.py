@@ -1,10 +1,12 @@
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.httpauth import HTTPBasicAuth
 
 app = Flask(__name__)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+
+from app.engine import RoutingSQLAlchemy, apply_profile
+apply_profile(app)
+db = RoutingSQLAlchemy(app)
 auth = HTTPBasicAuth()
 
 from app import routes
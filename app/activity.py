@@ -0,0 +1,70 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+from app.models import User
+
+class ActivityBuffer(object):
+    """ Collects users' last_activity timestamps in memory and writes them in batches.
+
+    touch() only records the timestamp. A background thread, started by the
+    first touch() in each worker process, writes every pending timestamp
+    each ACTIVITY_FLUSH_INTERVAL seconds in a single executemany UPDATE on
+    its own connection, so no request waits on the write.
+
+    last_activity is passive bookkeeping: writing it invalidates no cache
+    or ETag, cached user responses show it as of their last real change.
+
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def touch(self, user_id, when=None):
+        """ Records activity for 'user_id', starting this process's flush thread if needed. """
+        with self.lock:
+            self.pending[user_id] = when or datetime.utcnow()
+            # A forked worker inherits the object but not the thread
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='activity-flush')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        """ Flushes the buffer every ACTIVITY_FLUSH_INTERVAL seconds, for the life of the process. """
+        while True:
+            time.sleep(app.config['ACTIVITY_FLUSH_INTERVAL'])
+            self.flush()
+
+    def flush(self):
+        """ Writes every pending timestamp to the database, returns how many were written. """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        table = User.__table__
+        statement = table.update().where(table.c.id == bindparam('_id'))\
+                .values(last_activity=bindparam('_last_activity'))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, [{'_id': user_id, '_last_activity': when}\
+                        for user_id, when in pending.items()])
+        except SQLAlchemyError:
+            app.logger.exception('Unable to flush user activity, will retry')
+            with self.lock:
+                for user_id, when in pending.items():
+                    self.pending.setdefault(user_id, when)
+            return 0
+        return len(pending)
+
+activity = ActivityBuffer()
+atexit.register(activity.flush)
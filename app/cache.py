@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_request_context
+
+def cache_tag(*tags):
+    """ Records that the response being built depends on 'tags' (e.g. 'beer:4').
+
+    Serializers call this for every object they output, the response cache
+    stores the collected tags with the response.
+
+    """
+    if has_request_context() and 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+class TTLCache(object):
+    """ A bounded, thread-safe LRU cache whose entries expire after 'ttl' seconds.
+
+    Entries can carry a tag, invalidate(tag) then drops every entry stored
+    with it (e.g. everything cached for one user).
+
+    """
+
+    def __init__(self, maxsize, ttl):
+        """ Creates an empty cache holding at most 'maxsize' entries. """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ Returns the value stored for 'key', or None if missing or expired. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, tag, value = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tag=None):
+        """ Stores 'value' under 'key', evicting the least recently used entry when full. """
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, tag, value)
+            if tag is not None:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tag):
+        """ Drops every entry stored with 'tag'. """
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        """ Drops every entry. """
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key):
+        expires, tag, value = self.entries.pop(key)
+        if tag is not None:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
@@ -0,0 +1,44 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+
+from app import app
+from app.models import TableVersion
+
+def conditional(*tables):
+    """ Decorator adding ETag and Last-Modified headers to a GET route.
+
+    Both are derived from the version counters of 'tables', the tables the
+    route's response is built from. A request whose If-None-Match or
+    If-Modified-Since still matches gets a 304 before the route runs.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = TableVersion.current(tables)
+            tag = '{}|{}'.format(request.url, sorted((name, version)\
+                    for name, (version, modified) in versions.items()))
+            etag = hashlib.sha1(tag.encode('utf-8')).hexdigest()
+            stamps = [modified.replace(microsecond=0)\
+                    for version, modified in versions.values() if modified]
+            last_modified = max(stamps) if stamps else None
+
+            if 'If-None-Match' in request.headers:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = last_modified is not None and \
+                        request.if_modified_since is not None and \
+                        last_modified <= request.if_modified_since
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
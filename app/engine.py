@@ -0,0 +1,169 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from functools import partial
+from flask import request, g, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import create_engine, event, orm, select, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+
+# Requests that only read, their queries go to the read engine
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Layout of the change times compared for read-your-writes, sorts like the times themselves
+CHANGE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+class RoutingSession(_SignallingSession):
+    """ Session sending the queries of read-only requests to the read engine.
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary, as
+    does everything outside a request (scripts, tests, the activity buffer).
+
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not isinstance(clause, UpdateBase) and\
+                self.db.reads_from_replica():
+            return self.db.get_read_engine()
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy extension with pooled SQLite engines and read/write routing.
+
+    SQLAlchemy opens a new connection per checkout for file databases
+    (NullPool), which would re-run the pragmas on every request. With a pool
+    size configured a QueuePool is used instead.
+
+    GET requests read from SQLALCHEMY_READ_DATABASE_URI (a replica) or, when
+    that isn't set, from separate query_only connections to the primary.
+
+    Read-your-writes stickiness travels with the client, so it holds
+    whichever worker serves the next request: a successful write returns
+    the primary's latest TableVersion change time in the READ_STICKY_COOKIE
+    cookie (and header of the same name, for clients without cookies). A
+    read carrying it goes to the primary until the replica has applied a
+    change at least that recent, for at most READ_STICKY_SECONDS.
+
+    """
+
+    def __init__(self, app=None, **kwargs):
+        self.read_engine = None
+        self.read_lock = threading.Lock()
+        super(RoutingSQLAlchemy, self).__init__(app, **kwargs)
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            options.setdefault('poolclass', QueuePool)
+
+    def get_read_engine(self):
+        """ Returns the engine for read-only requests, rebuilt when the configured URI changes. """
+        app = self.get_app()
+        uri = app.config['SQLALCHEMY_READ_DATABASE_URI'] or app.config['SQLALCHEMY_DATABASE_URI']
+        with self.read_lock:
+            if self.read_engine is None or self.read_engine.uri != uri:
+                if self.read_engine is not None:
+                    self.read_engine.dispose()
+                info = make_url(uri)
+                options = {}
+                self.apply_pool_defaults(app, options)
+                self.apply_driver_hacks(app, info, options)
+                engine = create_engine(info, **options)
+                if info.drivername == 'sqlite':
+                    event.listen(engine, 'connect', sqlite_pragmas([('query_only', 1)]))
+                engine.uri = uri
+                self.read_engine = engine
+            return self.read_engine
+
+    def last_change(self, engine):
+        """ Returns the time of the latest change recorded in TableVersion on 'engine', as a string. """
+        from app.models import TableVersion
+        table = TableVersion.__table__
+        modified = engine.execute(select([func.max(table.c.modified)])).scalar()
+        return modified.strftime(CHANGE_FORMAT) if modified is not None else None
+
+    def mark_writer(self, response):
+        """ Makes the client's reads stick to the primary until the replica has its write. """
+        app = self.get_app()
+        written = self.last_change(self.engine)
+        if written is None:
+            return
+        name = app.config['READ_STICKY_COOKIE']
+        response.set_cookie(name, written, max_age=app.config['READ_STICKY_SECONDS'])
+        response.headers[name] = written
+
+    def replica_behind(self):
+        """ Returns True if the client wrote something the read engine hasn't applied yet. """
+        name = self.get_app().config['READ_STICKY_COOKIE']
+        written = request.headers.get(name) or request.cookies.get(name)
+        try:
+            expires = datetime.strptime(written or '', CHANGE_FORMAT) +\
+                    timedelta(seconds=self.get_app().config['READ_STICKY_SECONDS'])
+        except ValueError:
+            return False
+        if expires < datetime.utcnow():
+            return False
+        replicated = self.last_change(self.get_read_engine())
+        return replicated is None or replicated < written
+
+    def reads_from_replica(self):
+        """ Returns True if the current request's queries should use the read engine, decided once per request. """
+        if not has_request_context() or request.method not in READ_METHODS:
+            return False
+        replica = getattr(g, 'reads_from_replica', None)
+        if replica is None:
+            replica = g.reads_from_replica = not self.replica_behind()
+        return replica
+
+def sqlite_pragmas(pragmas):
+    """ Returns a 'connect' event listener running each (name, value) PRAGMA on new SQLite connections.
+
+    Connections to other databases are left alone.
+
+    """
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+    return set_pragmas
+
+def apply_profile(app):
+    """ Configures the database engine for the DATABASE_PROFILE in 'app.config'.
+
+    Called before the SQLAlchemy extension is set up. The 'development'
+    profile changes nothing. The 'production' profile runs SQLITE_PRAGMAS
+    on every new connection and replaces Flask-SQLAlchemy's one connection
+    per checkout with a pool of SQLITE_POOL_SIZE connections shared between
+    threads (each used by one thread at a time).
+
+    """
+    profile = app.config.get('DATABASE_PROFILE', 'development')
+    if profile == 'development':
+        return
+    if profile != 'production':
+        raise ValueError('Unknown DATABASE_PROFILE {!r}'.format(profile))
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite:///') and 'check_same_thread' not in uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri + ('&' if '?' in uri else '?')\
+                + 'check_same_thread=false'
+    for key, value in (('SQLALCHEMY_POOL_SIZE', 'SQLITE_POOL_SIZE'),\
+            ('SQLALCHEMY_MAX_OVERFLOW', 'SQLITE_POOL_OVERFLOW'),\
+            ('SQLALCHEMY_POOL_TIMEOUT', 'SQLITE_POOL_TIMEOUT')):
+        if app.config.get(key) is None:
+            app.config[key] = app.config[value]
+    event.listen(Engine, 'connect', sqlite_pragmas(app.config['SQLITE_PRAGMAS']))
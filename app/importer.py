@@ -0,0 +1,210 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+import numpy
+from flask import json
+from sqlalchemy import and_, select
+
+from app import app, db
+from app.models import User, Beer, BeerScore, Review, TableVersion, parse_id_or_uri,\
+        existing_ids
+from app.pagination import parse_datetime
+from app.response_cache import invalidate_cache
+
+def read_records(lines):
+    """ Parses NDJSON 'lines' (str or bytes), yields (line_number, record, error) for each non-blank line. """
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeError:
+                yield number, None, u'Line is not valid UTF-8'
+                continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None, u'Line is not valid JSON'
+            continue
+        if type(record) != dict:
+            yield number, None, u'Expecting a JSON object'
+            continue
+        yield number, record, None
+
+# score_value() codes for a missing, non-numeric or negative score
+MISSING = -1
+INVALID = -2
+NEGATIVE = -3
+
+# Scores above this are all equally out of bounds, and still fit an int64
+LARGEST = 2 ** 62
+
+def score_value(value):
+    """ Returns a score as an int, or its MISSING/INVALID/NEGATIVE code. """
+    if value is None:
+        return MISSING
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return INVALID
+    return NEGATIVE if value < 0 else min(value, LARGEST)
+
+def score_errors(records):
+    """ Validates the scores of a whole chunk of records at once, returns {position: error}.
+
+    Scores are converted into a records x categories numpy matrix and
+    checked against the Review.score_max bounds column-wise, a record's
+    error is reported for its first failing category.
+
+    """
+    categories = list(Review.score_max)
+    if not records:
+        return {}
+    scores = numpy.array([[score_value(record.get(category)) for category in categories]\
+            for record in records], dtype=numpy.int64)
+    highest = numpy.array([Review.score_max[category] for category in categories])
+    problems = numpy.select([scores == MISSING, scores == INVALID,\
+            (scores == NEGATIVE) | (scores > highest)], [1, 2, 3], 0)
+    failing = problems.any(axis=1)
+    first = problems.argmax(axis=1)
+    messages = {1: u'Missing value for ', 2: u'Invalid score for ',\
+            3: u'Score out of bounds for '}
+    return dict((int(position), messages[problems[position, first[position]]] +\
+            categories[first[position]]) for position in numpy.nonzero(failing)[0])
+
+# Pairs looked up per recent_reviews() query: their two IN lists and the date
+# range stay below SQLite's 999 bound variables whatever IMPORT_CHUNK_SIZE is
+RECENT_BATCH_SIZE = 400
+
+def recent_reviews(pairs, earliest, latest):
+    """ Returns {(author_id, beer_id): [created_on, ...]} for reviews of 'pairs' within a week of the date range. """
+    table = Review.__table__
+    week = timedelta(weeks=1)
+    found = defaultdict(list)
+    pairs = sorted(pairs)
+    for start in range(0, len(pairs), RECENT_BATCH_SIZE):
+        batch = set(pairs[start:start + RECENT_BATCH_SIZE])
+        authors = set(author_id for author_id, beer_id in batch)
+        beers = set(beer_id for author_id, beer_id in batch)
+        rows = db.session.execute(select([table.c.author_id, table.c.beer_id,\
+                table.c.created_on]).where(and_(table.c.author_id.in_(authors),\
+                table.c.beer_id.in_(beers), table.c.created_on > earliest - week,\
+                table.c.created_on < latest + week)))
+        for author_id, beer_id, created_on in rows:
+            if (author_id, beer_id) in batch:
+                found[(author_id, beer_id)].append(created_on)
+    return found
+
+def import_chunk(chunk, author_id=None):
+    """ Validates and inserts one chunk of (line_number, record) pairs in a single transaction.
+
+    Returns the number of reviews inserted and a list of errors for the
+    rejected records.
+
+    """
+    errors = []
+    scores = score_errors([record for number, record in chunk])
+    candidates = []
+    for position, (number, record) in enumerate(chunk):
+        if position in scores:
+            errors.append({'line': number, 'error': scores[position]})
+            continue
+        if record.get('beer_id') is None:
+            errors.append({'line': number, 'error': u'Missing value for beer_id'})
+            continue
+        created_on = datetime.utcnow()
+        if record.get('created_on') is not None:
+            created_on = parse_datetime(record['created_on'])
+            if created_on is None:
+                errors.append({'line': number, 'error': u'Invalid created_on value'})
+                continue
+        author = author_id
+        if author is None:
+            author = parse_id_or_uri(record.get('author')) if record.get('author') is not None\
+                    else None
+        candidates.append((number, record, parse_id_or_uri(record['beer_id']), author,\
+                created_on))
+    if not candidates:
+        return 0, errors
+
+    # Resolve every beer (and author) reference in the chunk with one query each
+    beers = existing_ids(Beer, [c[2] for c in candidates])
+    authors = set([author_id]) if author_id is not None else\
+            existing_ids(User, [c[3] for c in candidates])
+    valid = []
+    for candidate in candidates:
+        number, record, beer_id, author, created_on = candidate
+        if beer_id not in beers:
+            errors.append({'line': number, 'error': u'That beer does not exist'})
+        elif author is None:
+            errors.append({'line': number, 'error': u'Missing value for author'})
+        elif author not in authors:
+            errors.append({'line': number, 'error': u'That author does not exist'})
+        else:
+            valid.append(candidate)
+    if not valid:
+        return 0, errors
+
+    # One review per beer per week, against the database and the chunk itself
+    reviewed = recent_reviews(set((c[3], c[2]) for c in valid),\
+            min(c[4] for c in valid), max(c[4] for c in valid))
+    rows, totals = [], {}
+    for number, record, beer_id, author, created_on in valid:
+        dates = reviewed[(author, beer_id)]
+        if any(abs(created_on - date) < timedelta(weeks=1) for date in dates):
+            errors.append({'line': number,\
+                    'error': u'Beer already reviewed by that author that week'})
+            continue
+        dates.append(created_on)
+        row = dict((category, int(record[category])) for category in BeerScore.categories)
+        beer_totals = totals.setdefault(beer_id, defaultdict(int))
+        for category, value in row.items():
+            beer_totals[category] += value
+        beer_totals['count'] += 1
+        row.update(beer_id=beer_id, author_id=author, created_on=created_on)
+        rows.append(row)
+    if not rows:
+        return 0, errors
+
+    db.session.execute(Review.__table__.insert(), rows)
+    for beer_id, beer_totals in totals.items():
+        BeerScore.adjust(beer_id, beer_totals, count=beer_totals['count'])
+    TableVersion.bump('review')
+    invalidate_cache('reviews', *(['beer:{}'.format(beer_id) for beer_id in totals] +\
+            ['user:{}'.format(author) for author in set(row['author_id'] for row in rows)]))
+    db.session.commit()
+    return len(rows), errors
+
+def import_reviews(lines, author_id=None):
+    """ Imports reviews from NDJSON 'lines', committing every IMPORT_CHUNK_SIZE records.
+
+    Each record holds beer_id and the five scores, optionally created_on
+    (ISO 8601) and, unless 'author_id' is given, the author's id or link.
+    Rejected records don't stop the import, they're returned in the error
+    report as {'line': ..., 'error': ...}.
+
+    Keyword arguments:
+
+    |  **lines**     -- iterable of NDJSON lines (a file or request stream)
+    |  **author_id** -- import every review as this user
+
+    """
+    imported, errors = 0, []
+    records = read_records(lines)
+    while True:
+        batch = list(islice(records, app.config['IMPORT_CHUNK_SIZE']))
+        if not batch:
+            break
+        chunk = []
+        for number, record, error in batch:
+            if error is not None:
+                errors.append({'line': number, 'error': error})
+            else:
+                chunk.append((number, record))
+        if chunk:
+            count, chunk_errors = import_chunk(chunk, author_id)
+            imported += count
+            errors.extend(chunk_errors)
+    return imported, sorted(errors, key=lambda e: e['line'])
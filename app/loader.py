@@ -0,0 +1,57 @@
+from collections import defaultdict
+from flask import g
+
+# Relationship name -> function resolving a set of keys with a single query
+resolvers = {}
+
+def resolver(name):
+    """ Decorator registering the function that resolves relationship 'name'.
+
+    The function receives a set of keys and returns a dictionary mapping each
+    key to its list of related objects, keys without any may be left out.
+
+    """
+    def decorator(f):
+        resolvers[name] = f
+        return f
+    return decorator
+
+class BatchLoader(object):
+    """ Collects relationship keys while serializing and resolves them in batches.
+
+    Serializers register() the keys they're going to need, the first load()
+    for a relationship then fetches every registered key with one IN query.
+
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.loaded = defaultdict(dict)
+
+    def clear(self):
+        """ Forgets every loaded and pending key, e.g. once a streamed chunk is sent. """
+        self.pending.clear()
+        self.loaded.clear()
+
+    def register(self, name, key):
+        """ Queue 'key' to be resolved with the next batch for relationship 'name'. """
+        if key not in self.loaded[name]:
+            self.pending[name].add(key)
+
+    def load(self, name, key):
+        """ Returns the related objects for 'key', resolving the pending batch if needed. """
+        loaded = self.loaded[name]
+        if key not in loaded:
+            keys = self.pending.pop(name, set())
+            keys.add(key)
+            results = resolvers[name](keys)
+            for k in keys:
+                loaded[k] = results.get(k, [])
+        return loaded[key]
+
+def get_loader():
+    """ Returns the BatchLoader for the current request, creating it on first use. """
+    loader = getattr(g, 'batch_loader', None)
+    if loader is None:
+        loader = g.batch_loader = BatchLoader()
+    return loader
@@ -1,10 +1,18 @@
-from flask import url_for
 from datetime import datetime
+from collections import defaultdict
+import hashlib
+import hmac
 from passlib.apps import custom_app_context as pwd_context
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import SignatureExpired, BadSignature
+from flask import abort
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select, bindparam, case
+from sqlalchemy.orm import contains_eager
 from app import db, app
+from app.loader import get_loader, resolver
+from app.cache import TTLCache
+from app.serializers import Schema, Link, Computed
 
 # Model independant id_or_uri_check
 def is_model_id_or_uri(session, model, data):
@@ -31,12 +39,119 @@ def is_model_id_or_uri(session, model, data):
             return int(uri)
     return None
 
+def parse_id_or_uri(data):
+    """ Return the integer id in 'data' (an int, digit string or api link), or None.
+
+    Unlike is_model_id_or_uri this doesn't check the id exists, so a batch of
+    references can be parsed first and looked up with existing_ids().
+
+    """
+    if type(data) == int:
+        return data
+    uri = str(data).split('/')[-1]
+    if uri.isdigit():
+        return int(uri)
+    return None
+
+def existing_ids(model, ids):
+    """ Return the subset of 'ids' that are primary keys of 'model', using a single IN query. """
+    ids = set(id for id in ids if id is not None)
+    if not ids:
+        return set()
+    key = model.__table__.c.id
+    return set(id for (id,) in db.session.execute(select([key]).where(key.in_(ids))))
+
+# Token signers keyed on expiration time, built once and reused
+token_signers = {}
+
+def token_signer(expiration):
+    """ Returns the shared token Serializer for tokens valid for 'expiration' seconds. """
+    signer = token_signers.get(expiration)
+    if signer is None:
+        signer = token_signers[expiration] = \
+                Serializer(app.config['SECRET_KEY'], expires_in=expiration)
+    return signer
+
+# Recently validated auth tokens, token -> (user id, username)
+identity_cache = TTLCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
 # Favorites list relationship table
 favorite = db.Table('favorites',
-        db.Column('beer_id', db.Integer, db.ForeignKey('beer.id')),
-        db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
+        db.Column('beer_id', db.Integer, db.ForeignKey('beer.id'), index=True),
+        db.Column('user_id', db.Integer, db.ForeignKey('user.id'), index=True)
         )
 
+class TableVersion(db.Model):
+    """ Database model counting the changes made to another table.
+
+    Write routes bump() the tables they touch in the same transaction, read
+    routes use the counters to answer conditional GETs without querying.
+
+    Properties:
+
+    |  **name** -- name of the tracked table.
+    |  **version** -- incremented on every change to the table.
+    |  **modified** -- datetime of the last change.
+
+    """
+    __tablename__ = 'table_version'
+
+    name = db.Column(db.String(60), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<TableVersion {} {}>'.format(self.name, self.version)
+
+    @classmethod
+    def bump(self, *names, connection=None):
+        """ Records a change to each table in 'names'.
+
+        Runs on the session unless a 'connection' is given, either way it
+        belongs in the transaction making the change.
+
+        """
+        execute = (connection or db.session).execute
+        table = self.__table__
+        now = datetime.utcnow()
+        for name in sorted(set(names)):
+            result = execute(table.update().where(table.c.name == name)\
+                    .values(version=table.c.version + 1, modified=now))
+            if result.rowcount == 0:
+                execute(table.insert().values(name=name, version=1, modified=now))
+
+    @classmethod
+    def current(self, names):
+        """ Returns a {name: (version, modified)} dictionary for 'names' using one query. """
+        table = self.__table__
+        rows = db.session.execute(select([table.c.name, table.c.version, table.c.modified])\
+                .where(table.c.name.in_(names)))
+        versions = dict((name, (0, None)) for name in names)
+        versions.update((name, (version, modified)) for name, version, modified in rows)
+        return versions
+
+class CacheInvalidation(db.Model):
+    """ Database model logging response-cache tags dropped by writes.
+
+    Every worker replays new rows before serving from its response cache,
+    so an invalidation made by one worker reaches all of them.
+
+    Properties:
+
+    |  **tag** -- the invalidated tag (e.g. 'beer:4' or 'beers').
+    |  **created_on** -- datetime the invalidation was logged.
+
+    """
+    __tablename__ = 'cache_invalidation'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    tag = db.Column(db.String(60))
+    created_on = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<CacheInvalidation {}>'.format(self.tag)
+
 class User(db.Model):
     """ Database model representing a single User.
 
@@ -46,17 +161,23 @@ class User(db.Model):
     |  **email**    -- the users email address (unused).
     |  **password** -- the users password hash.
     |  **created_on** -- datetime from moment of creation.
-    |  **last_activity** -- datetime from last authenticated api call.
+    |  **last_activity** -- datetime from last authenticated api call, written in
+                            batches and possibly stale in cached responses.
     |  **last_beer_added** -- datetime from last added beer (for 24 hour limit).
     |  **reviews** -- reviews writen by the User.
     |  **favorites** -- list of User's favorite beers.
 
     """
+    # List arguments accepted by the users listing, sorting only by indexed columns
+    sort_fields = ('id', 'username', 'created_on')
+    filter_fields = {'created_after': ('created_on', '>', 'datetime'),\
+            'created_before': ('created_on', '<', 'datetime')}
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(60), unique=True)
     email = db.Column(db.String(200))
     password = db.Column(db.String(128))
-    created_on = db.Column(db.DateTime)
+    created_on = db.Column(db.DateTime, index=True)
     last_activity = db.Column(db.DateTime)
     last_beer_added = db.Column(db.DateTime)
     reviews = db.relationship('Review', backref='author', lazy='dynamic')
@@ -77,9 +198,7 @@ class User(db.Model):
 
     def serialize(self):
         """ Return a JSON representation of a User object.  """
-        return {'username':self.username, 'email':self.email, \
-                'link':url_for('edit_user', id=self.id, _external=True), \
-                'created_on':self.created_on, 'last_activity':self.last_activity}
+        return self.schema.serialize(self)
 
     def add_to_favorites(self, beer):
         """ Add a beer to users favorites list, checks for redundancy. """
@@ -97,21 +216,44 @@ class User(db.Model):
 
     @staticmethod
     def check_auth_token(token):
-        """ Validates a user's authentication token, checks for expiration. """
-        s = Serializer(app.config['SECRET_KEY'])
+        """ Validates a user's authentication token, checks for expiration.
+
+        The first use of a token checks its claims against the database, after
+        that a UserIdentity is built straight from the claims for up to
+        IDENTITY_CACHE_TTL seconds without a query. Changing a password or
+        deleting a user revokes the cached tokens of the worker doing it,
+        other workers notice within IDENTITY_CACHE_TTL.
+
+        """
         try:
-            data = s.loads(token)
+            data = token_signer(None).loads(token)
         except SignatureExpired:
             return None
         except BadSignature:
             return None
+        identity = identity_cache.get(token)
+        if identity is not None:
+            return UserIdentity(*identity)
         user = User.query.get(data['id'])
+        if user is None or data.get('stamp') != user.password_stamp():
+            return None
+        identity_cache.set(token, (user.id, user.username), tag=user.id)
         return user
 
+    @staticmethod
+    def revoke_auth_tokens(id):
+        """ Forgets this worker's cached token identities for user 'id', forcing them back to the database. """
+        identity_cache.invalidate(id)
+
     def generate_auth_token(self, expiration=1200):
         """ Generates a new authentication token for a user. """
-        s = Serializer(app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'id': self.id})
+        return token_signer(expiration).dumps({'id': self.id, 'username': self.username,\
+                'stamp': self.password_stamp()})
+
+    def password_stamp(self):
+        """ Returns a short keyed digest of the password hash, tokens carrying a stale one are rejected. """
+        return hmac.new(app.config['SECRET_KEY'].encode('utf-8'),\
+                self.password.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
 
     def hash_password(self, password):
         """ Creates a password hash from the plaintext. """
@@ -121,6 +263,35 @@ class User(db.Model):
         """ Confirms/validates a plaintext password against the users stored hash """
         return pwd_context.verify(password, self.password)
 
+class UserIdentity(object):
+    """ Stand-in for an authenticated User, built from validated token claims.
+
+    The id and username are available without touching the database, any
+    other attribute loads the User row once and is forwarded to it. A user
+    deleted since the token was validated is answered with a 401.
+
+    """
+
+    def __init__(self, id, username):
+        self.__dict__.update(id=id, username=username, user=None)
+
+    def __repr__(self):
+        return '<UserIdentity {}>'.format(self.username)
+
+    def load(self):
+        """ Returns the User row behind this identity, loading it on first use. """
+        if self.user is None:
+            self.__dict__['user'] = User.query.get(self.id)
+            if self.user is None:
+                abort(401)
+        return self.user
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
 class Glass(db.Model):
     """ Database model representing a style of beer Glass.
 
@@ -130,6 +301,9 @@ class Glass(db.Model):
     |  **beers** -- List of beers that should be served in said glass-type
 
     """
+    # List arguments accepted by the glasses listing
+    sort_fields = ('id', 'name')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True)
     beers = db.relationship('Beer', backref='glass_type', lazy='dynamic')
@@ -143,8 +317,15 @@ class Glass(db.Model):
 
     def serialize(self):
         """ Return a JSON representation of a Glass object.  """
-        return {'name':self.name, 'link':url_for('get_glass', id=self.id, _external=True),\
-                'beers':[b.serialize() for b in self.beers.all()]}
+        return self.schema.serialize(self)
+
+    @classmethod
+    def serialize_all(self, glasses):
+        """ Serialize a list of glasses, loading all of their beers with a single query. """
+        loader = get_loader()
+        for glass in glasses:
+            loader.register('glass.beers', glass.id)
+        return self.schema.serialize_all(glasses)
 
     @classmethod
     def id_or_uri_check(self, data):
@@ -154,16 +335,26 @@ class Glass(db.Model):
 class Beer(db.Model):
     """ Database model representing an individual Beer.  """
 
+    # List arguments accepted by the beers listing, every one backed by an index
+    sort_fields = ('id', 'name', 'brewer', 'style', 'abv', 'ibu', 'calories')
+    filter_fields = {'abv_min': ('abv', '>=', 'float'), 'abv_max': ('abv', '<=', 'float'),\
+            'ibu_min': ('ibu', '>=', 'int'), 'ibu_max': ('ibu', '<=', 'int'),\
+            'calories_min': ('calories', '>=', 'int'), 'calories_max': ('calories', '<=', 'int'),\
+            'style': ('style', '==', 'str'), 'brewer': ('brewer', '==', 'str'),\
+            'glass_type': ('glass_type_id', '==', 'id')}
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True)
-    brewer = db.Column(db.String(200)) #TODO: Implement Brewery object
-    ibu = db.Column(db.Integer)
-    calories = db.Column(db.Integer)
-    abv = db.Column(db.Float) 
-    style = db.Column(db.String(200))
+    brewer = db.Column(db.String(200), index=True) #TODO: Implement Brewery object
+    ibu = db.Column(db.Integer, index=True)
+    calories = db.Column(db.Integer, index=True)
+    abv = db.Column(db.Float, index=True)
+    style = db.Column(db.String(200), index=True)
     brew_location = db.Column(db.String)
-    glass_type_id = db.Column(db.Integer, db.ForeignKey('glass.id'))
+    glass_type_id = db.Column(db.Integer, db.ForeignKey('glass.id'), index=True)
     reviews = db.relationship('Review', backref='beer', lazy='dynamic')
+    scores = db.relationship('BeerScore', backref='beer', uselist=False, \
+            lazy='joined', cascade='all, delete-orphan')
 
     def __init__(self, name, brewer, ibu, calories, abv, style, brew_location):
         """ Creates a new Beer object. """
@@ -174,21 +365,14 @@ class Beer(db.Model):
         self.abv = abv 
         self.style = style
         self.brew_location = brew_location
+        self.scores = BeerScore()
 
     def __repr__(self):
         return '<Beer {}>'.format(self.name)
 
     def serialize(self):
         """ Return a JSON representation of a Beer object.  """
-        serial = {'name':self.name, 'brewer':self.brewer, 'ibu':self.ibu,\
-                'calories':self.calories, 'abv':self.abv, 'style':self.style,\
-                'brew_location':self.brew_location,\
-                'average_scores':self.average_scores,\
-                'link': url_for('get_beer', id=self.id, _external=True)}
-        if self.glass_type_id:
-            serial['glass_type'] = url_for('get_glass',\
-                    id=self.glass_type_id, _external=True)
-        return serial
+        return self.schema.serialize(self)
 
     @classmethod
     def id_or_uri_check(self, data):
@@ -197,17 +381,157 @@ class Beer(db.Model):
 
     @property
     def average_scores(self):
-        """ Finds other reviews for the same beer_id, and returns the average of their scores. """
-        totals = {'aroma':0, 'appearance':0, 'taste':0, 'palate':0, 'bottle_style':0}
-        for r in self.reviews.all():
-            totals['aroma'] += r.aroma
-            totals['appearance'] += r.appearance
-            totals['taste'] += r.taste
-            totals['palate'] += r.palate
-            totals['bottle_style'] += r.bottle_style
-        for key,value in totals.items():
-            totals[key] = value / (len(self.reviews.all()) or 1)
-        return totals
+        """ Returns the average of each score category, read from the beer's running totals. """
+        if self.scores is None:
+            return dict((category, 0.0) for category in BeerScore.categories)
+        return self.scores.averages()
+
+class BeerScore(db.Model):
+    """ Database model holding the running review-score totals for a Beer.
+
+    Kept up to date by the review routes through adjust(), so that
+    Beer.average_scores never has to touch the reviews table. The stored
+    averages are indexed, so a leaderboard is read straight off an index.
+
+    Properties:
+
+    |  **beer_id** -- the Beer these totals belong to.
+    |  **review_count** -- number of reviews summed into the totals.
+    |  **aroma, appearance, taste, palate, bottle_style** -- summed scores per category.
+    |  **<category>_average, overall_average** -- average scores (overall is the sum of the categories).
+
+    """
+    __tablename__ = 'beer_score'
+    categories = ('aroma', 'appearance', 'taste', 'palate', 'bottle_style')
+    rankings = categories + ('overall',)
+
+    beer_id = db.Column(db.Integer, db.ForeignKey('beer.id'), primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    aroma = db.Column(db.Integer, nullable=False, default=0)
+    appearance = db.Column(db.Integer, nullable=False, default=0)
+    taste = db.Column(db.Integer, nullable=False, default=0)
+    palate = db.Column(db.Integer, nullable=False, default=0)
+    bottle_style = db.Column(db.Integer, nullable=False, default=0)
+    aroma_average = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)
+    appearance_average = db.Column(db.Float, nullable=False, default=0, server_default='0',\
+            index=True)
+    taste_average = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)
+    palate_average = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)
+    bottle_style_average = db.Column(db.Float, nullable=False, default=0, server_default='0',\
+            index=True)
+    overall_average = db.Column(db.Float, nullable=False, default=0, server_default='0',\
+            index=True)
+
+    def __init__(self):
+        """ Creates an empty set of totals. """
+        self.review_count = 0
+        for category in self.categories:
+            setattr(self, category, 0)
+        for ranking in self.rankings:
+            setattr(self, ranking + '_average', 0.0)
+
+    def __repr__(self):
+        return '<BeerScore {}>'.format(self.beer_id)
+
+    def averages(self):
+        """ Returns a dictionary of the average score for each category. """
+        return dict((category, getattr(self, category) / (self.review_count or 1))\
+                for category in self.categories)
+
+    @classmethod
+    def adjust(self, beer_id, scores, count=0):
+        """ Adds the per-category deltas in 'scores' and 'count' to a beer's totals.
+
+        The update is applied in SQL so concurrent writers can't lose each
+        other's changes. Beers that predate the totals table get theirs
+        rebuilt from the reviews instead.
+
+        """
+        table = self.__table__
+        totals = dict((category, table.c[category] + int(scores.get(category) or 0))\
+                for category in self.categories)
+        values = dict(totals, review_count=table.c.review_count + count)
+        totals['overall'] = sum(totals[category] for category in self.categories)
+        for ranking in self.rankings:
+            values[ranking + '_average'] = case([(values['review_count'] > 0,\
+                    totals[ranking] * 1.0 / values['review_count'])], else_=0.0)
+        result = db.session.execute(table.update()\
+                .where(table.c.beer_id == beer_id).values(**values))
+        if result.rowcount == 0:
+            self.rebuild([beer_id])
+        else:
+            self.expire([beer_id])
+
+    @classmethod
+    def rebuild(self, beer_ids=None):
+        """ Recomputes totals from the reviews table, returns the ids of beers whose stored totals were wrong.
+
+        Keyword arguments:
+
+        |  **beer_ids** -- limit the rebuild to these beers (default: every beer)
+
+        """
+        db.session.flush()
+        table = self.__table__
+        review = Review.__table__
+        totals_fields = ('review_count',) + self.categories
+        fields = totals_fields + tuple(ranking + '_average' for ranking in self.rankings)
+
+        actual = select([review.c.beer_id, func.count(review.c.id)] +\
+                [func.coalesce(func.sum(review.c[c]), 0) for c in self.categories])\
+                .group_by(review.c.beer_id)
+        stored = select([table.c.beer_id] + [table.c[f] for f in fields])
+        beers = select([Beer.__table__.c.id])
+        if beer_ids is not None:
+            actual = actual.where(review.c.beer_id.in_(beer_ids))
+            stored = stored.where(table.c.beer_id.in_(beer_ids))
+            beers = beers.where(Beer.__table__.c.id.in_(beer_ids))
+        actual = dict((row[0], self.with_averages(row[1:])) for row in db.session.execute(actual))
+        stored = dict((row[0], tuple(row[1:])) for row in db.session.execute(stored))
+
+        inserts, updates, changed = [], [], []
+        for (beer_id,) in db.session.execute(beers):
+            totals = actual.get(beer_id, self.with_averages((0,) * len(totals_fields)))
+            if stored.get(beer_id) == totals:
+                continue
+            changed.append(beer_id)
+            row = dict(zip(fields, totals))
+            if beer_id in stored:
+                row['_beer_id'] = beer_id
+                updates.append(row)
+            else:
+                row['beer_id'] = beer_id
+                inserts.append(row)
+        if updates:
+            db.session.execute(table.update()\
+                    .where(table.c.beer_id == bindparam('_beer_id'))\
+                    .values(dict((f, bindparam(f)) for f in fields)), updates)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        self.expire(changed)
+        return changed
+
+    @classmethod
+    def with_averages(self, totals):
+        """ Appends the averages in 'rankings' order to a (review_count, category totals...) tuple. """
+        count = totals[0]
+        sums = tuple(totals[1:]) + (sum(totals[1:]),)
+        return tuple(totals) + tuple((total / count if count else 0.0) for total in sums)
+
+    @classmethod
+    def top_query(self, ranking, n, min_reviews):
+        """ Returns a query of the 'n' beers with the best 'ranking' average and at least 'min_reviews' reviews. """
+        column = self.__table__.c[ranking + '_average']
+        return Beer.query.join(Beer.scores).options(contains_eager(Beer.scores))\
+                .filter(self.review_count >= min_reviews)\
+                .order_by(column.desc(), self.beer_id.desc()).limit(n)
+
+    @classmethod
+    def expire(self, beer_ids):
+        """ Expires any loaded totals for 'beer_ids' so they're re-read after a SQL-side update. """
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, BeerScore) and obj.beer_id in beer_ids:
+                db.session.expire(obj)
 
 class Review(db.Model):
     """ Database model representing a beer Review.
@@ -222,14 +546,28 @@ class Review(db.Model):
 
     """
 
+    # Answers "has this author reviewed this beer since <date>" from the index alone,
+    # and as its leading column also serves lookups by author_id
+    __table_args__ = (db.Index('ix_review_author_beer_created_on',\
+            'author_id', 'beer_id', 'created_on'),)
+
+    # Highest score allowed in each category (the lowest is 0)
+    score_max = {'aroma':5, 'appearance':5, 'taste':10, 'palate':5, 'bottle_style':5}
+
+    # List arguments accepted by the review listings, sorting only by indexed columns
+    sort_fields = ('id', 'created_on')
+    filter_fields = {'beer': ('beer_id', '==', 'id'), 'author': ('author_id', '==', 'id'),\
+            'created_after': ('created_on', '>', 'datetime'),\
+            'created_before': ('created_on', '<', 'datetime')}
+
     id = db.Column(db.Integer, primary_key=True)
     aroma = db.Column(db.Integer)
     appearance = db.Column(db.Integer)
     taste = db.Column(db.Integer)
     palate = db.Column(db.Integer)
     bottle_style = db.Column(db.Integer)
-    created_on = db.Column(db.DateTime)
-    beer_id = db.Column(db.Integer, db.ForeignKey('beer.id'))
+    created_on = db.Column(db.DateTime, index=True)
+    beer_id = db.Column(db.Integer, db.ForeignKey('beer.id'), index=True)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     def __init__(self, beer_id, author_id, data):
@@ -245,12 +583,12 @@ class Review(db.Model):
 
     def serialize(self):
         """ Return a JSON representation of a Review object.  """
-        return {'author': url_for('get_user', id=self.author_id, _external=True),\
-                'beer': url_for('get_beer', id=self.beer_id, _external=True),\
-                'link': url_for('get_review', id=self.id, _external=True),\
-                'aroma': self.aroma, 'appearance': self.appearance, 'taste': self.taste,\
-                'palate': self.palate, 'bottle_style': self.bottle_style,\
-                'overall':self.overall}
+        return self.schema.serialize(self)
+
+    def score_values(self):
+        """ Returns a dictionary of the Review's score for each category. """
+        return dict((category, getattr(self, category) or 0)\
+                for category in BeerScore.categories)
 
     def update_score_values(self, data):
         """ Updates a Review's scores based on a passed in dictionary. """
@@ -269,8 +607,7 @@ class Review(db.Model):
     def validate_score_values(self, data):
         """ Checks that a score-dictionary's values are within review-category constraints.  """
         #TODO: Maybe return a tuple with an error message? (e.g. which was invalid)
-        score_max = {'aroma':5, 'appearance':5, 'taste':10, 'palate':5, 'bottle_style':5}
-        for category, value in score_max.items():
+        for category, value in self.score_max.items():
             try:
                 if int(data[category]) < 0 or int(data[category]) > value:
                     return False # score is out of bounds
@@ -280,9 +617,69 @@ class Review(db.Model):
                 pass # score missing a category
         return True
     
+    @classmethod
+    def reviewed_since(self, author_id, beer_id, since):
+        """ Returns True if 'author_id' has reviewed 'beer_id' after the datetime 'since'. """
+        return db.session.query(self.id).filter(self.author_id == author_id,\
+                self.beer_id == beer_id, self.created_on > since).first() is not None
+
     @property
     def overall(self):
         """ Returns the sum of all the Reviews categories. """
         return self.aroma + self.appearance + self.taste + self.palate +\
                 self.bottle_style
 
+# JSON representations, the column-computed fields also serialize row tuples
+def score_averages(review_count, *totals):
+    """ Returns the average of each score category from a beer's review count and totals. """
+    return dict((category, (total or 0) / (review_count or 1))\
+            for category, total in zip(BeerScore.categories, totals))
+
+def review_overall(*scores):
+    """ Returns the sum of a review's scores. """
+    return sum(scores)
+
+def glass_beers(glass_id):
+    """ Returns the serialized beers served in a glass, batched through the request's loader. """
+    return Beer.schema.serialize_all(get_loader().load('glass.beers', glass_id))
+
+User.schema = Schema('user', [('username', 'username'), ('email', 'email'),\
+        ('link', Link('edit_user')), ('created_on', 'created_on'),\
+        ('last_activity', 'last_activity')])
+
+Glass.schema = Schema('glass', [('name', 'name'), ('link', Link('get_glass')),\
+        ('beers', Computed(glass_beers, ('id',)))])
+
+Beer.schema = Schema('beer', [('name', 'name'), ('brewer', 'brewer'), ('ibu', 'ibu'),\
+        ('calories', 'calories'), ('abv', 'abv'), ('style', 'style'),\
+        ('brew_location', 'brew_location'),\
+        ('average_scores', Computed(score_averages, ('review_count',) + BeerScore.categories,\
+        attribute='average_scores')),\
+        ('link', Link('get_beer')),\
+        ('glass_type', Link('get_glass', 'glass_type_id', optional=True))])
+
+Review.schema = Schema('review', [('author', Link('get_user', 'author_id')),\
+        ('beer', Link('get_beer', 'beer_id')), ('link', Link('get_review')),\
+        ('aroma', 'aroma'), ('appearance', 'appearance'), ('taste', 'taste'),\
+        ('palate', 'palate'), ('bottle_style', 'bottle_style'),\
+        ('overall', Computed(review_overall, BeerScore.categories, attribute='overall'))])
+
+# Batch loaders for relationships serialized across many objects
+@resolver('glass.beers')
+def load_glass_beers(glass_ids):
+    """ Returns the beers served in each of 'glass_ids'. """
+    beers = defaultdict(list)
+    for beer in Beer.query.filter(Beer.glass_type_id.in_(glass_ids)).order_by(Beer.id):
+        beers[beer.glass_type_id].append(beer)
+    return beers
+
+@resolver('user.favorites')
+def load_user_favorites(user_ids):
+    """ Returns the favorite beers of each of 'user_ids'. """
+    beers = defaultdict(list)
+    query = db.session.query(favorite.c.user_id, Beer).select_from(favorite)\
+            .join(Beer, favorite.c.beer_id == Beer.id)\
+            .filter(favorite.c.user_id.in_(user_ids))
+    for user_id, beer in query:
+        beers[user_id].append(beer)
+    return beers
@@ -0,0 +1,201 @@
+import math
+import operator
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import request, url_for, abort, flash, json
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime, Integer, Float, Numeric
+
+from app import app
+
+def parse_datetime(value):
+    """ Returns the datetime in an ISO 8601 string (date, or date and time), or None if it can't be parsed. """
+    if type(value) != str:
+        return None
+    value = value.replace('T', ' ').rstrip('Z')
+    for layout in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, layout)
+        except ValueError:
+            pass
+    return None
+
+def parse_id(value):
+    """ Returns the id in a filter value given as an id or an api link, or None. """
+    id = value.rstrip('/').split('/')[-1]
+    return int(id) if id.isdigit() else None
+
+def parse_float(value):
+    """ Returns the finite float in a filter value, or None ('nan' and 'inf' compare to nothing useful). """
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+# Converters for the filter value types named in a model's filter_fields
+filter_types = {'str': str, 'int': int, 'float': parse_float, 'datetime': parse_datetime,\
+        'id': parse_id}
+
+# Comparisons allowed in a model's filter_fields
+filter_operators = {'==': operator.eq, '<': operator.lt, '<=': operator.le,\
+        '>': operator.gt, '>=': operator.ge}
+
+def page_size():
+    """ Returns the page size requested with the 'limit' query argument.
+
+    Falls back to API_PAGE_SIZE and never exceeds API_MAX_PAGE_SIZE.
+
+    """
+    limit = request.args.get('limit') or None
+    if limit is None:
+        return app.config['API_PAGE_SIZE']
+    if not limit.isdigit() or int(limit) < 1:
+        flash(u'Invalid limit specified', 'error')
+        abort(400)
+    return min(int(limit), app.config['API_MAX_PAGE_SIZE'])
+
+def parse_sort(model, sort):
+    """ Returns a (column, descending) pair for a 'sort_by' value such as 'abv desc'.
+
+    Keyword arguments:
+
+    |  **model** -- the db.Model class being listed
+    |  **sort**  -- the raw sort_by value, None sorts by primary key
+
+    Only the columns in the model's sort_fields are accepted, each of them is
+    indexed so that a page is read straight off the index.
+
+    """
+    if not sort:
+        return model.__table__.c.id, False
+    parts = sort.split()
+    if len(parts) not in (1, 2) or parts[0] not in model.sort_fields or \
+            (len(parts) == 2 and parts[1].lower() not in ('asc', 'desc')):
+        flash(u'Invalid sorting value specified', 'error')
+        abort(400)
+    return model.__table__.c[parts[0]], len(parts) == 2 and parts[1].lower() == 'desc'
+
+def encode_cursor(value, id):
+    """ Packs the sort value and id of the last row on a page into an opaque cursor. """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([value, id]).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def cursor_types(column):
+    """ Returns the JSON types a cursor's sort value may have for 'column'.
+
+    Text is always accepted, SQLite keeps text stored in a numeric column as
+    text and its cursor has to page past it.
+
+    """
+    if isinstance(column.type, Integer):
+        return (str, int)
+    if isinstance(column.type, (Float, Numeric)):
+        return (str, int, float)
+    return (str,)
+
+def decode_cursor(cursor, column):
+    """ Unpacks a cursor made by encode_cursor() into a (value, id) pair, aborts on garbage. """
+    try:
+        data = urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        data = json.loads(data.decode('utf-8'))
+        if type(data) != list or len(data) != 2:
+            raise ValueError(u'Cursor is not a (value, id) pair')
+        value, id = data
+        if type(id) != int or (value is not None and (isinstance(value, bool) or\
+                not isinstance(value, cursor_types(column)))):
+            raise ValueError(u'Invalid value types in cursor')
+        if any(type(v) == int and not -2 ** 63 <= v < 2 ** 63 for v in data):
+            raise ValueError(u'Integer out of range in cursor')
+        if value is not None and isinstance(column.type, DateTime):
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(u'Invalid datetime in cursor')
+        return value, id
+    except (ValueError, TypeError, UnicodeError):
+        flash(u'Invalid cursor specified', 'error')
+        abort(400)
+
+def after_cursor(column, key, value, id, descending):
+    """ Returns the clause selecting rows that sort after (value, id).
+
+    SQLite sorts NULLs first, so NULL sort values are handled explicitly.
+
+    """
+    if not descending:
+        if value is None:
+            return or_(and_(column == None, key > id), column != None)
+        return or_(column > value, and_(column == value, key > id))
+    if value is None:
+        return and_(column == None, key < id)
+    return or_(column < value, and_(column == value, key < id), column == None)
+
+def filter_values(model):
+    """ Returns (column name, comparison, value) for each filter query argument in the model's filter_fields.
+
+    Each entry maps an argument name to a (column, comparison, value type)
+    triple, e.g. 'abv_min': ('abv', '>=', 'float'). Other arguments are ignored.
+
+    """
+    filters = []
+    for name, (column, comparison, kind) in sorted(getattr(model, 'filter_fields', {}).items()):
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            value = filter_types[kind](value)
+        except ValueError:
+            value = None
+        if value is None:
+            flash(u'Invalid value for filter ' + name, 'error')
+            abort(400)
+        filters.append((column, comparison, value))
+    return filters
+
+def filtered(query, model):
+    """ Returns 'query' narrowed by the filter query arguments, see filter_values(). """
+    for column, comparison, value in filter_values(model):
+        query = query.filter(filter_operators[comparison](model.__table__.c[column], value))
+    return query
+
+def ordered(query, model):
+    """ Returns 'query' filtered and ordered by the query arguments, resumed from the 'after' cursor.
+
+    The primary key breaks ties, so rows keep a stable order across pages.
+
+    """
+    query = filtered(query, model)
+    column, descending = parse_sort(model, request.args.get('sort_by'))
+    key = model.__table__.c.id
+    after = request.args.get('after') or None
+    if after is not None:
+        value, id = decode_cursor(after, column)
+        query = query.filter(after_cursor(column, key, value, id, descending))
+    if descending:
+        return query.order_by(column.desc(), key.desc())
+    return query.order_by(column, key)
+
+def paginate(query, model, endpoint, **values):
+    """ Returns one page of 'query' and a link to the next page (or None).
+
+    Pages are ordered by the 'sort_by' query argument with the primary key
+    as tie-breaker, and continue from the 'after' cursor of the previous
+    page, so a deep page costs the same as the first one.
+
+    Keyword arguments:
+
+    |  **query**    -- the query to paginate
+    |  **model**    -- the db.Model class being listed
+    |  **endpoint** -- the route used to build the 'next' link
+    |  **values**   -- extra url_for() values for the endpoint (e.g. id)
+
+    """
+    column, descending = parse_sort(model, request.args.get('sort_by'))
+    limit = page_size()
+    rows = ordered(query, model).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    args = request.args.to_dict()
+    args['after'] = encode_cursor(getattr(rows[-1], column.name), rows[-1].id)
+    args.update(values)
+    return rows, url_for(endpoint, _external=True, **args)
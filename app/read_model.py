@@ -0,0 +1,360 @@
+import math
+import os
+import pickle
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from numbers import Number
+from flask import request, url_for
+from sqlalchemy import select
+
+from app import app, db
+from app.models import Beer, BeerScore
+from app.pagination import parse_sort, page_size, decode_cursor, encode_cursor,\
+        filter_values, filter_operators
+from app.similar import beer_version
+
+# Integer columns store NULL as the smallest value, float columns as NaN
+NULL = -2 ** 63
+NAN = float('nan')
+INFINITY = float('inf')
+
+# Columns kept in typed arrays, the others are text
+number_columns = {'abv': 'd', 'ibu': 'q', 'calories': 'q', 'glass_type_id': 'q'}
+text_columns = ('name', 'brewer', 'style', 'brew_location')
+
+# Layout of the row tuples of a page
+record_columns = ('id', 'abv', 'ibu', 'calories', 'glass_type_id') + text_columns
+
+# Filter columns answered by bisecting their sorted index rather than checking every beer
+range_columns = ('abv', 'ibu')
+
+class BeerText(object):
+    """ The text columns of one beer. """
+    __slots__ = text_columns
+
+    def __init__(self, name, brewer, style, brew_location):
+        self.name = name
+        self.brewer = brewer
+        self.style = style
+        self.brew_location = brew_location
+
+    def __getstate__(self):
+        return (self.name, self.brewer, self.style, self.brew_location)
+
+    def __setstate__(self, state):
+        self.name, self.brewer, self.style, self.brew_location = state
+
+def sort_key(value):
+    """ Returns the key ordering column values like SQLite, NULLs first. """
+    return (0, 0) if value is None else (1, value)
+
+def write_snapshot(path, data):
+    """ Writes pickled snapshot 'data' to 'path', replacing any previous snapshot atomically. """
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+class CatalogReadModel(object):
+    """ In-process copy of the beer table answering beer listings without the database.
+
+    Numeric columns live in compact typed arrays and text columns in
+    __slots__ records, one entry per beer. Every sortable column has a
+    sorted list of (key, id) pairs: listings walk it from the page cursor,
+    and abv/ibu range filters bisect it. Only the score totals of the beers
+    on a page are read from the database.
+
+    Like the similar beers index, the model tracks the beer table version:
+    write routes apply their own changes, a table changed by another worker
+    is reloaded. A worker that starts without a current snapshot at
+    READ_MODEL_SNAPSHOT_PATH loads the table and writes one. A background
+    thread then rewrites it every READ_MODEL_SNAPSHOT_INTERVAL seconds if
+    the model changed, so no write waits on it.
+
+    Values SQLite stored with the wrong type (e.g. text in abv) can't be
+    held in the arrays, listings go to the database while any beer has one.
+
+    """
+
+    def __init__(self):
+        self.version = None
+        self.snapshot_version = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Empties the model. """
+        self.ids = array('q')
+        self.numbers = dict((column, array(code)) for column, code in number_columns.items())
+        self.texts = []
+        self.positions = {}
+        self.inexact = set()
+        self.indexes = dict((field, []) for field in Beer.sort_fields)
+
+    @property
+    def exact(self):
+        """ True unless a stored beer has a value the arrays couldn't hold. """
+        return not self.inexact
+
+    def value(self, position, column):
+        """ Returns a column value of the beer at 'position'. """
+        if column == 'id':
+            return self.ids[position]
+        if column in text_columns:
+            return getattr(self.texts[position], column)
+        value = self.numbers[column][position]
+        if value == NULL or (isinstance(value, float) and math.isnan(value)):
+            return None
+        return value
+
+    def packed(self, column, value):
+        """ Returns 'value' as stored in a numeric column's array, None if it can't be. """
+        if value is None:
+            return NAN if number_columns[column] == 'd' else NULL
+        if number_columns[column] == 'd' and isinstance(value, Number):
+            return float(value)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        return None
+
+    def store(self, row, indexed=True):
+        """ Adds or replaces a beer from a row of rows_query(), leaving the sorted indexes to reindex() unless 'indexed'. """
+        id = row['id']
+        position = self.positions.get(id)
+        if position is not None:
+            self.unindex(position)
+        else:
+            position = self.positions[id] = len(self.ids)
+            self.ids.append(id)
+            for column in number_columns:
+                self.numbers[column].append(0)
+            self.texts.append(None)
+        self.inexact.discard(id)
+        for column in number_columns:
+            value = self.packed(column, row[column])
+            if value is None:
+                self.inexact.add(id)
+                value = NAN if number_columns[column] == 'd' else NULL
+            self.numbers[column][position] = value
+        self.texts[position] = BeerText(*[row[column] for column in text_columns])
+        if indexed:
+            for field, index in self.indexes.items():
+                insort(index, (sort_key(self.value(position, field)), id))
+
+    def reindex(self):
+        """ Rebuilds every sorted index from the stored beers in one pass each. """
+        self.indexes = dict((field, sorted((sort_key(self.value(position, field)), id)\
+                for id, position in self.positions.items())) for field in Beer.sort_fields)
+
+    def unindex(self, position):
+        """ Drops the beer at 'position' from the sorted indexes. """
+        id = self.ids[position]
+        for field, index in self.indexes.items():
+            del index[bisect_left(index, (sort_key(self.value(position, field)), id))]
+
+    def discard(self, id):
+        """ Removes a beer, the last beer takes its place in the arrays. """
+        position = self.positions.pop(id, None)
+        if position is None:
+            return
+        self.inexact.discard(id)
+        self.unindex(position)
+        last = len(self.ids) - 1
+        if position != last:
+            for column in self.numbers.values():
+                column[position] = column[last]
+            self.ids[position] = self.ids[last]
+            self.texts[position] = self.texts[last]
+            self.positions[self.ids[position]] = position
+        for column in [self.ids] + list(self.numbers.values()):
+            column.pop()
+        self.texts.pop()
+
+    def rows_query(self, ids=None):
+        """ Returns the select of the stored columns, for 'ids' or every beer. """
+        table = Beer.__table__
+        query = select([table.c.id] + [table.c[column] for column in number_columns] +\
+                [table.c[column] for column in text_columns])
+        if ids is not None:
+            query = query.where(table.c.id.in_(ids))
+        return query
+
+    def load(self, version):
+        """ Rebuilds the model from the beer table. """
+        self.clear()
+        for row in db.session.execute(self.rows_query().order_by(Beer.__table__.c.id)):
+            self.store(row, indexed=False)
+        self.reindex()
+        self.version = version
+
+    def dumps(self):
+        """ Returns the pickled columns, marking the current version as snapshotted. """
+        self.snapshot_version = self.version
+        return pickle.dumps((self.version, self.inexact, self.ids, self.numbers, self.texts),\
+                pickle.HIGHEST_PROTOCOL)
+
+    def save(self, path):
+        """ Writes the columns to 'path', replacing any previous snapshot atomically. """
+        write_snapshot(path, self.dumps())
+
+    def snapshot(self):
+        """ Writes a snapshot to READ_MODEL_SNAPSHOT_PATH if the model changed since the last one, returns True if it did. """
+        with self.lock:
+            if self.version is None or self.version == self.snapshot_version:
+                return False
+            data = self.dumps()
+        write_snapshot(app.config['READ_MODEL_SNAPSHOT_PATH'], data)
+        return True
+
+    def run(self):
+        """ Snapshots the model every READ_MODEL_SNAPSHOT_INTERVAL seconds, for the life of the process. """
+        while True:
+            time.sleep(app.config['READ_MODEL_SNAPSHOT_INTERVAL'])
+            try:
+                self.snapshot()
+            except (IOError, OSError):
+                app.logger.exception('Unable to snapshot the catalog read model, will retry')
+
+    def restore(self, path, version):
+        """ Loads the snapshot at 'path' if it was taken at 'version', returns True if it was. """
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot[0] != version:
+            return False
+        self.version, self.inexact, self.ids, self.numbers, self.texts = snapshot
+        self.snapshot_version = self.version
+        self.positions = dict((id, position) for position, id in enumerate(self.ids))
+        self.reindex()
+        return True
+
+    def current(self):
+        """ Brings the model to the beer table's version, from the snapshot on first use. """
+        # A forked worker inherits the object but not the snapshot thread
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run, name='catalog-snapshot')
+            thread.daemon = True
+            thread.start()
+        version = beer_version()
+        if self.version == version:
+            return
+        path = app.config['READ_MODEL_SNAPSHOT_PATH']
+        if self.version is None:
+            if not self.restore(path, version):
+                self.load(version)
+                self.save(path)
+        else:
+            self.load(version)
+
+    def upsert(self, ids, version):
+        """ Re-reads beers written in the transaction that reached 'version'. """
+        with self.lock:
+            if self.version != version - 1:
+                self.version = None
+                return
+            for row in db.session.execute(self.rows_query(ids)):
+                self.store(row)
+            self.version = version
+
+    def remove(self, ids, version):
+        """ Drops beers deleted in the transaction that reached 'version'. """
+        with self.lock:
+            if self.version != version - 1:
+                self.version = None
+                return
+            for id in ids:
+                self.discard(id)
+            self.version = version
+
+    def candidates(self, filters):
+        """ Returns the ids within every abv/ibu range filter, or None without such filters. """
+        found = None
+        for column, comparison, value in filters:
+            if column not in range_columns or comparison not in ('<=', '>='):
+                continue
+            index = self.indexes[column]
+            if comparison == '>=':
+                ids = index[bisect_left(index, (sort_key(value),)):]
+            else:
+                ids = index[bisect_left(index, ((1, -INFINITY),)):\
+                        bisect_right(index, (sort_key(value), INFINITY))]
+            ids = set(id for key, id in ids)
+            found = ids if found is None else found & ids
+        return found
+
+    def matches(self, position, filters):
+        """ Returns True if the beer at 'position' passes every filter (NULL never does). """
+        for column, comparison, value in filters:
+            stored = self.value(position, column)
+            if stored is None or not filter_operators[comparison](stored, value):
+                return False
+        return True
+
+    def page(self):
+        """ Returns the beers listing page for the request, like paginate(), or None to use the database.
+
+        Pages are row tuples laid out as record_columns, ordered by the 'sort_by'
+        argument with the id breaking ties and continuing after the 'after'
+        cursor.
+
+        """
+        column, descending = parse_sort(Beer, request.args.get('sort_by'))
+        field = column.name
+        limit = page_size()
+        filters = filter_values(Beer)
+        after = request.args.get('after') or None
+        if after is not None:
+            after = decode_cursor(after, column)
+            # Text only sorts among numbers in the database
+            if field in number_columns and isinstance(after[0], str):
+                return None
+        with self.lock:
+            self.current()
+            if not self.exact:
+                return None
+            ids = self.candidates(filters)
+            if ids is None:
+                order = self.indexes[field]
+            else:
+                order = sorted((sort_key(self.value(self.positions[id], field)), id)\
+                        for id in ids)
+            if not descending:
+                start = bisect_right(order, (sort_key(after[0]), after[1])) if after else 0
+                walk = (order[i] for i in range(start, len(order)))
+            else:
+                end = bisect_left(order, (sort_key(after[0]), after[1])) if after\
+                        else len(order)
+                walk = (order[i] for i in range(end - 1, -1, -1))
+            rows = []
+            for key, id in walk:
+                position = self.positions[id]
+                if self.matches(position, filters):
+                    rows.append(tuple(self.value(position, c) for c in record_columns))
+                    if len(rows) > limit:
+                        break
+        next = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            args = request.args.to_dict()
+            args['after'] = encode_cursor(rows[-1][record_columns.index(field)], rows[-1][0])
+            next = url_for('list_beers', _external=True, **args)
+        return rows, next
+
+def serialize_page(rows):
+    """ Returns the serialized beers of a read model page, joining their score totals read in one query. """
+    table = BeerScore.__table__
+    score_columns = ('review_count',) + BeerScore.categories
+    query = select([table.c.beer_id] + [table.c[c] for c in score_columns])\
+            .where(table.c.beer_id.in_([row[0] for row in rows]))
+    totals = dict((row[0], tuple(row[1:])) for row in db.session.execute(query)) if rows else {}
+    missing = (0,) * len(score_columns)
+    return Beer.schema.serialize_all([row + totals.get(row[0], missing) for row in rows],\
+            record_columns + score_columns)
+
+# This worker's read model, used when READ_MODEL_ENABLED is set
+catalog = CatalogReadModel()
@@ -0,0 +1,292 @@
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict
+import numpy
+from sqlalchemy import select, func, literal, union_all
+
+from app import app, db
+from app.models import Review, favorite
+
+# Affinity a favorite adds to a user/beer pair, a review adds its overall
+# score divided by the highest possible overall (so at most 1.0 too)
+FAVORITE_WEIGHT = 1.0
+MAX_OVERALL = float(sum(Review.score_max.values()))
+
+def review_weight(row):
+    """ Returns the affinity a review row (with the five score columns) adds. """
+    return sum((getattr(row, category) or 0) for category in Review.score_max) / MAX_OVERALL
+
+def user_vectors(user_ids=None, max_review_id=None):
+    """ Returns {user_id: {beer_id: affinity}} built from favorites and reviews.
+
+    Keyword arguments:
+
+    |  **user_ids**      -- only these users (default: everyone)
+    |  **max_review_id** -- ignore reviews newer than this id
+
+    """
+    vectors = defaultdict(lambda: defaultdict(float))
+    favorites = select([favorite.c.user_id, favorite.c.beer_id])
+    review = Review.__table__
+    reviews = select([review.c.id, review.c.author_id, review.c.beer_id] +\
+            [review.c[category] for category in Review.score_max])
+    if user_ids is not None:
+        favorites = favorites.where(favorite.c.user_id.in_(user_ids))
+        reviews = reviews.where(review.c.author_id.in_(user_ids))
+    if max_review_id is not None:
+        reviews = reviews.where(review.c.id <= max_review_id)
+    for user_id, beer_id in db.session.execute(favorites):
+        vectors[user_id][beer_id] += FAVORITE_WEIGHT
+    for row in db.session.execute(reviews):
+        vectors[row.author_id][row.beer_id] += review_weight(row)
+    return vectors
+
+def history(vector, max_history):
+    """ Returns (beer ids, affinities) arrays of a user's 'max_history' strongest affinities, ties to the lowest id. """
+    items = sorted(vector.items(), key=lambda item: (-item[1], item[0]))[:max_history]
+    return numpy.array([beer_id for beer_id, weight in items], dtype=numpy.int64),\
+            numpy.array([weight for beer_id, weight in items], dtype=float)
+
+def user_history(user_id, max_history):
+    """ Returns history() for one user, summed and capped by the database in a single query. """
+    review = Review.__table__
+    weight = sum(func.coalesce(review.c[category], 0) for category in Review.score_max) /\
+            MAX_OVERALL
+    affinities = union_all(\
+            select([favorite.c.beer_id, literal(FAVORITE_WEIGHT).label('weight')])\
+            .where(favorite.c.user_id == user_id),\
+            select([review.c.beer_id, weight.label('weight')])\
+            .where(review.c.author_id == user_id)).alias('affinities')
+    total = func.sum(affinities.c.weight)
+    rows = db.session.execute(select([affinities.c.beer_id, total])\
+            .group_by(affinities.c.beer_id).order_by(total.desc(), affinities.c.beer_id)\
+            .limit(max_history)).fetchall()
+    return numpy.array([row[0] for row in rows], dtype=numpy.int64),\
+            numpy.array([row[1] for row in rows], dtype=float)
+
+# Pair keys are beer_id * PAIR_STRIDE + other_id, beer ids stay below it
+PAIR_STRIDE = 2 ** 31
+
+# User histories folded into the pair arrays at a time, bounding the memory of a build
+FOLD_CHUNK = 1000
+
+def empty_pairs():
+    """ Returns the (keys, dots, counts) arrays of a matrix without any pair. """
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64)
+
+def combine(keys, dots, counts):
+    """ Sums the dots and counts of equal keys, returns them sorted by key without the pairs no user has left. """
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    dots = numpy.bincount(inverse, weights=dots, minlength=len(keys))
+    counts = numpy.rint(numpy.bincount(inverse, weights=counts, minlength=len(keys)))\
+            .astype(numpy.int64)
+    present = counts != 0
+    return keys[present], dots[present], counts[present]
+
+class CooccurrenceMatrix(object):
+    """ Beer co-occurrence matrix of the user/beer affinity matrix, kept by the model builder.
+
+    The matrix is held in coordinate form: sorted numpy arrays of pair
+    keys, dot products and the number of users behind each pair, the
+    diagonal holding each beer's squared norm. Only each user's
+    'max_history' strongest affinities count.
+
+    sync() folds in reviews written since the last build by replacing the
+    histories of their authors, so a synced matrix equals a fresh build.
+    Favorites changed since the build count once the user reviews again, or
+    at the next build. Workers never see the matrix, only the pruned
+    SimilarityModel computed from it.
+
+    """
+
+    def __init__(self, max_history, pairs=None, histories=None, last_review_id=0):
+        self.max_history = max_history
+        self.pairs = pairs or empty_pairs()
+        self.histories = histories or {}
+        self.last_review_id = last_review_id
+
+    @classmethod
+    def build(self, max_history):
+        """ Computes the matrix from the whole database. """
+        last_review_id = db.session.execute(select([func.max(Review.__table__.c.id)]))\
+                .scalar() or 0
+        matrix = self(max_history, last_review_id=last_review_id)
+        matrix.histories = dict((user_id, history(vector, max_history))\
+                for user_id, vector in user_vectors(max_review_id=last_review_id).items())
+        matrix.pairs = matrix.fold(list(matrix.histories.values()), [])
+        return matrix
+
+    def fold(self, added, removed):
+        """ Returns the pair arrays with the products of the 'added' histories summed in and the 'removed' ones taken out. """
+        histories = [(ids, weights, 1) for ids, weights in added] +\
+                [(ids, weights, -1) for ids, weights in removed]
+        pairs = self.pairs
+        for start in range(0, len(histories), FOLD_CHUNK):
+            chunk = histories[start:start + FOLD_CHUNK]
+            keys, dots, counts = [pairs[0]], [pairs[1]], [pairs[2]]
+            for ids, weights, sign in chunk:
+                keys.append((ids[:, None] * PAIR_STRIDE + ids[None, :]).ravel())
+                dots.append(sign * numpy.outer(weights, weights).ravel())
+                counts.append(numpy.repeat(sign, len(ids) ** 2))
+            pairs = combine(numpy.concatenate(keys), numpy.concatenate(dots),\
+                    numpy.concatenate(counts))
+        return pairs
+
+    def sync(self, batch_size):
+        """ Folds up to 'batch_size' reviews written since the last build or sync into the matrix, returns how many. """
+        review = Review.__table__
+        rows = db.session.execute(select([review.c.id, review.c.author_id])\
+                .where(review.c.id > self.last_review_id)\
+                .order_by(review.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return 0
+        authors = set(row.author_id for row in rows)
+        vectors = user_vectors(authors, rows[-1].id)
+        added = dict((user_id, history(vectors[user_id], self.max_history))\
+                for user_id in authors)
+        removed = [self.histories[user_id] for user_id in authors if user_id in self.histories]
+        self.pairs = self.fold(list(added.values()), removed)
+        self.histories.update(added)
+        self.last_review_id = rows[-1].id
+        return len(rows)
+
+    def similarities(self):
+        """ Returns the (beer ids, other beer ids, cosine similarities) of every off-diagonal pair. """
+        keys, dots = self.pairs[0], self.pairs[1]
+        rows, others = keys // PAIR_STRIDE, keys % PAIR_STRIDE
+        diagonal = rows == others
+        norms = dict(zip(rows[diagonal].tolist(), dots[diagonal].tolist()))
+        rows, others, dots = rows[~diagonal], others[~diagonal], dots[~diagonal]
+        lookup = numpy.vectorize(lambda id: norms.get(id, 0.0), otypes=[float])
+        norm = numpy.sqrt(lookup(rows) * lookup(others)) if len(rows) else numpy.zeros(0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return rows, others, numpy.where(norm > 0, dots / norm, 0.0)
+
+    def model(self, neighbors):
+        """ Returns the SimilarityModel keeping each beer's 'neighbors' most similar beers, ties to the lowest id. """
+        rows, others, similarity = self.similarities()
+        order = numpy.lexsort((others, -similarity, rows))
+        rows, others, similarity = rows[order], others[order], similarity[order]
+        rank = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+        keep = (rank < neighbors) & (similarity > 0)
+        rows, others, similarity = rows[keep], others[keep], similarity[keep]
+        beer_ids = numpy.unique(rows)
+        offsets = numpy.append(numpy.searchsorted(rows, beer_ids), len(rows))
+        return SimilarityModel(self.max_history, beer_ids, offsets, others, similarity,\
+                self.last_review_id)
+
+class SimilarityModel(object):
+    """ Item-item cosine similarity between beers, from users' favorites and reviews.
+
+    Each beer's most similar beers are stored as one row of a compressed
+    sparse matrix: sorted beer ids, the offsets of each row, and the
+    neighbour ids and similarities of all rows back to back. It's computed
+    by CooccurrenceMatrix.model(), saved to RECOMMEND_MODEL_PATH by
+    ./run.py --buildrecommendations (or kept current with new reviews by
+    --refreshrecommendations) and loaded by each worker.
+
+    A recommendation only reads the rows of the user's own beers.
+
+    """
+
+    def __init__(self, max_history, beer_ids=None, offsets=None, neighbor_ids=None,\
+            similarities=None, last_review_id=0):
+        self.max_history = max_history
+        self.beer_ids = numpy.zeros(0, dtype=numpy.int64) if beer_ids is None else beer_ids
+        self.offsets = numpy.zeros(1, dtype=numpy.int64) if offsets is None else offsets
+        self.neighbor_ids = numpy.zeros(0, dtype=numpy.int64) if neighbor_ids is None\
+                else neighbor_ids
+        self.similarities = numpy.zeros(0) if similarities is None else similarities
+        self.last_review_id = last_review_id
+
+    @classmethod
+    def load(self, path):
+        """ Returns the model saved at 'path'. """
+        with open(path, 'rb') as f:
+            return self(*pickle.load(f))
+
+    def save(self, path):
+        """ Writes the model to 'path', replacing any previous file atomically. """
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((self.max_history, self.beer_ids, self.offsets, self.neighbor_ids,\
+                    self.similarities, self.last_review_id), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def recommend(self, ids, weights, n):
+        """ Returns up to 'n' (beer_id, score) pairs for a user's history() arrays, best first.
+
+        Beers are scored by their summed similarity to the user's beers,
+        weighted by the user's affinity. Beers the user already has are left
+        out.
+
+        """
+        positions = numpy.searchsorted(self.beer_ids, ids)
+        found = positions < len(self.beer_ids)
+        found[found] = self.beer_ids[positions[found]] == ids[found]
+        positions, weights = positions[found], weights[found]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        if not lengths.sum():
+            return []
+        rows = numpy.repeat(numpy.arange(len(positions)), lengths)
+        entries = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths,\
+                lengths) + numpy.repeat(starts, lengths)
+        others = self.neighbor_ids[entries]
+        keep = ~numpy.in1d(others, ids)
+        if not keep.any():
+            return []
+        candidates, inverse = numpy.unique(others[keep], return_inverse=True)
+        scores = numpy.bincount(inverse, weights=(weights[rows] * self.similarities[entries])[keep],\
+                minlength=len(candidates))
+        best = [i for i in numpy.lexsort((candidates, -scores)).tolist() if scores[i] > 0][:n]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+
+def refresh(matrix, path):
+    """ Folds every review written since the matrix was last synced into it, saves its model to 'path' if any, returns how many. """
+    synced = 0
+    while True:
+        count = matrix.sync(app.config['RECOMMEND_SYNC_BATCH'])
+        db.session.commit()
+        if not count:
+            break
+        synced += count
+    if synced:
+        matrix.model(app.config['RECOMMEND_NEIGHBORS']).save(path)
+    return synced
+
+def keep_refreshed(path, interval):
+    """ Builds the model into 'path', then refreshes it every 'interval' seconds, forever.
+
+    Only this process holds the co-occurrence matrix, workers pick up each
+    saved model when they see the file change.
+
+    """
+    matrix = CooccurrenceMatrix.build(app.config['RECOMMEND_MAX_HISTORY'])
+    db.session.commit()
+    matrix.model(app.config['RECOMMEND_NEIGHBORS']).save(path)
+    while True:
+        time.sleep(interval)
+        refresh(matrix, path)
+
+# This worker's copy of the model and the artifact modification time it was loaded from
+model = None
+model_mtime = None
+model_lock = threading.Lock()
+
+def get_model():
+    """ Returns this worker's model, (re)loading it when the artifact on disk changes.
+
+    A database without an artifact gets an empty model.
+
+    """
+    global model, model_mtime
+    path = app.config['RECOMMEND_MODEL_PATH']
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    with model_lock:
+        if model is None or mtime != model_mtime:
+            model = SimilarityModel.load(path) if mtime is not None else\
+                    SimilarityModel(app.config['RECOMMEND_MAX_HISTORY'])
+            model_mtime = mtime
+        return model
@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, g, make_response
+from sqlalchemy import select
+
+from app import app, db
+from app.models import CacheInvalidation
+
+class ResponseCache(object):
+    """ LRU cache of GET response bodies, bounded by their total size in bytes.
+
+    Each entry is stored with the tags of everything it was built from, and
+    invalidate() drops exactly the entries carrying a given tag.
+
+    """
+
+    def __init__(self, max_bytes):
+        """ Creates an empty cache holding at most 'max_bytes' of response bodies. """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.last_seen = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the (body, mimetype) cached for 'key', or None. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key, body, mimetype, tags):
+        """ Caches a response body under 'key', evicting least recently used entries to fit. """
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (body, mimetype, tags)
+            self.size += len(body)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        """ Drops every entry built from any of 'tags'. """
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """ Drops every entry. """
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def reset(self):
+        """ Drops every entry and forgets the invalidation log position (e.g. after rebuilding the database). """
+        self.clear()
+        self.last_seen = None
+
+    def sync(self):
+        """ Applies invalidations logged by any worker since the last sync.
+
+        If the log was pruned past the last row seen, everything is dropped.
+        The log is read from the primary database: a replica lagging behind
+        would let responses built from newer rows outlive their invalidation.
+
+        """
+        table = CacheInvalidation.__table__
+        if self.last_seen is None:
+            self.clear()
+            self.last_seen = db.engine.execute(select([db.func.max(table.c.id)]))\
+                    .scalar() or 0
+            return
+        rows = db.engine.execute(select([table.c.id, table.c.tag])\
+                .where(table.c.id > self.last_seen).order_by(table.c.id)).fetchall()
+        if not rows:
+            return
+        if rows[0][0] != self.last_seen + 1:
+            self.clear()
+        else:
+            self.invalidate(*set(tag for id, tag in rows))
+        self.last_seen = rows[-1][0]
+
+    def stats(self):
+        """ Returns a dictionary of hit/miss counters and memory use. """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),\
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+    def _remove(self, key):
+        body, mimetype, tags = self.entries.pop(key)
+        self.size -= len(body)
+        for tag in tags:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+def invalidate_cache(*tags, connection=None):
+    """ Logs 'tags' as invalidated, dropping matching responses in every worker.
+
+    Runs on the session unless a 'connection' is given, either way it belongs
+    in the transaction making the change. Rows older than
+    RESPONSE_CACHE_LOG_RETENTION seconds are pruned at the same time.
+
+    """
+    execute = (connection or db.session).execute
+    table = CacheInvalidation.__table__
+    now = datetime.utcnow()
+    execute(table.insert(), [{'tag': tag, 'created_on': now} for tag in sorted(set(tags))])
+    cutoff = now - timedelta(seconds=app.config['RESPONSE_CACHE_LOG_RETENTION'])
+    execute(table.delete().where(table.c.created_on < cutoff))
+
+def cached(*tags):
+    """ Decorator caching a GET route's response, keyed on its full url.
+
+    'tags' name the collections the response lists (e.g. 'beers'), the tags
+    of every serialized object are added while the route runs.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response_cache.sync()
+            key = request.url
+            entry = response_cache.get(key)
+            if entry is not None:
+                return app.response_class(entry[0], mimetype=entry[1])
+            g.cache_tags = set(tags)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response.get_data(), response.mimetype,\
+                        frozenset(g.cache_tags))
+            return response
+        return wrapper
+    return decorator
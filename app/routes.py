@@ -1,10 +1,29 @@
 from flask import jsonify, request, url_for, abort, flash, get_flashed_messages,\
         g, make_response
-from sqlalchemy.exc import OperationalError
 from datetime import datetime, timedelta
+import hashlib
+import hmac
 
 from app import app, db, auth
-from app.models import User, Glass, Beer, Review
+from app.models import User, Glass, Beer, BeerScore, Review, TableVersion,\
+        favorite, parse_id_or_uri, existing_ids, load_user_favorites
+from app.pagination import paginate, page_size
+from app.streaming import wants_stream, stream_results
+from app.activity import activity
+from app.conditional import conditional
+from app.response_cache import response_cache, cached, invalidate_cache
+from app.cache import TTLCache, cache_tag
+from app.importer import import_reviews
+from app.engine import READ_METHODS
+from app.search import search_terms, search_index_exists, search, like_search
+from app.recommend import get_model, user_history
+from app.similar import similar_index, feature_row, beer_version
+from app.stats import catalog_stats
+from app.read_model import catalog, serialize_page
+
+def glass_tags(*ids):
+    """ Returns the response cache tags of glass-types 'ids', beers without a glass have none. """
+    return ['glass:{}'.format(id) for id in set(ids) if id is not None]
 
 @app.route('/beer/api/v0.1/token')
 @auth.login_required
@@ -23,12 +42,15 @@ def get_auth_token():
 
 # User model routes
 @app.route('/beer/api/v0.1/users', methods = ['GET'])
+@conditional('user')
+@cached('users')
 def list_users():
     """ List all users in the database.
 
     |  **URL:** /beer/api/v0.1/users
     |  **Method:** GET
-    |  **Query Args:** sort_by=<column name> <desc?>
+    |  **Query Args:** sort_by=<id|username|created_on> <desc>, limit=<page size>, after=<cursor>, stream=true
+    |  **Filters:** created_after=<date>, created_before=<date>
     |  **Authentication:** None
 
     Examples:
@@ -45,20 +67,24 @@ def list_users():
 
       GET http://domain.tld/beer/api/v0.1/users?sort_by=username%20desc
 
+    *Users who joined during 2014* ::
+
+      GET http://domain.tld/beer/api/v0.1/users?created_after=2014-01-01&created_before=2015-01-01
+
+    *Fetch the next page of users, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/users?limit=20&after=<cursor>
+
     """
 
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            users = User.query.order_by(sort).all()
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    else:
-        users = User.query.all()
-    return jsonify(results=[u.serialize() for u in users])
+    if wants_stream():
+        return stream_results(User.query, User)
+    users, next = paginate(User.query, User, 'list_users')
+    return jsonify(results=User.schema.serialize_all(users), next=next)
 
 @app.route('/beer/api/v0.1/users/<int:id>', methods = ['GET'])
+@conditional('user')
+@cached()
 def get_user(id):
     """ Retrieve information about a particular user.
 
@@ -79,12 +105,14 @@ def get_user(id):
     return jsonify(results=u.serialize())
 
 @app.route('/beer/api/v0.1/users/<int:id>/reviews', methods = ['GET'])
+@conditional('user', 'review')
+@cached()
 def get_user_reviews(id):
     """ Return list of reviews authored by a particular user.
 
     |  **URL:** /beer/api/v0.1/users/<user_id>/reviews
     |  **Method:** GET
-    |  **Query Args:** sort_by=<column_name> <desc>
+    |  **Query Args:** sort_by=<column_name> <desc>, limit=<page size>, after=<cursor>, stream=true
     |  **Authentication:** None
 
     Example:
@@ -93,22 +121,58 @@ def get_user_reviews(id):
 
       GET http://domain.tld/beer/api/v0.1/users/5/reviews
 
-    *Get reviews for user with id# 1 sorted by aroma* ::
+    *Get reviews for user with id# 1, newest first* ::
+
+      GET http://domain.tld/beer/api/v0.1/users/5/reviews?sort_by=created_on%20desc
 
-      GET http://domain.tld/beer/api/v0.1/users/5/reviews?sort_by=aroma
+    *Fetch the next page of reviews, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/users/5/reviews?limit=20&after=<cursor>
 
     """
 
     u = User.query.get_or_404(id)
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            return jsonify(results=\
-                    [r.serialize() for r in u.reviews.order_by(sort)])
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    return jsonify(results=[r.serialize() for r in u.reviews])
+    cache_tag('user:{}'.format(id))
+    if wants_stream():
+        return stream_results(u.reviews, Review)
+    reviews, next = paginate(u.reviews, Review, 'get_user_reviews', id=id)
+    return jsonify(results=Review.schema.serialize_all(reviews), next=next)
+
+@app.route('/beer/api/v0.1/users/<int:id>/recommendations', methods = ['GET'])
+def get_user_recommendations(id):
+    """ Beers a particular user may like, from the favorites and reviews of users with similar taste.
+
+    Beers are scored by their similarity to the beers the user favorited
+    or reviewed, using the item-item model built by
+    ./run.py --buildrecommendations and kept current with new reviews.
+    Beers the user already favorited or reviewed are left out.
+
+    |  **URL:** /beer/api/v0.1/users/<user_id>/recommendations
+    |  **Method:** GET
+    |  **Query Args:** n=<number of beers>
+    |  **Authentication:** None
+
+    Example:
+
+    *Get 20 recommendations for user with id# 5* ::
+
+      GET http://domain.tld/beer/api/v0.1/users/5/recommendations?n=20
+
+    """
+
+    u = User.query.get_or_404(id)
+    n = request.args.get('n') or str(app.config['RECOMMEND_DEFAULT_SIZE'])
+    if not n.isdigit() or int(n) < 1:
+        flash(u'Invalid n specified', 'error')
+        abort(400)
+    model = get_model()
+    ids, weights = user_history(u.id, model.max_history)
+    scores = model.recommend(ids, weights, min(int(n), app.config['API_MAX_PAGE_SIZE']))
+    beers = dict((b.id, b) for b in Beer.query.filter(Beer.id.in_([id for id, score in scores])))\
+            if scores else {}
+    scores = [(beers[id], score) for id, score in scores if id in beers]
+    return jsonify(results=[dict(serial, score=score) for serial, (b, score)\
+            in zip(Beer.schema.serialize_all([b for b, score in scores]), scores)])
 
 @app.route('/beer/api/v0.1/users', methods = ['POST'])
 def create_user():
@@ -141,6 +205,8 @@ def create_user():
         abort(400)
     user = User(username, email, password)
     db.session.add(user)
+    TableVersion.bump('user')
+    invalidate_cache('users')
     db.session.commit()
     return jsonify({'results': user.serialize(), 'status': 'User created successfully'}),\
             201, {'Location': url_for('get_user', id=user.id, _external=True)}
@@ -189,8 +255,13 @@ def edit_user(id):
             abort(400)
         u.email = email
     if password is not None:
-        u.password = u.hash_password(password)
+        u.hash_password(password)
+    TableVersion.bump('user')
+    invalidate_cache('users', 'user:{}'.format(id))
     db.session.commit()
+    if username is not None or password is not None:
+        credential_cache.invalidate(u.id)
+        User.revoke_auth_tokens(u.id)
     return jsonify({'status': 'User updated successfully', 'results': u.serialize()})
 
 @app.route('/beer/api/v0.1/users/<int:id>', methods = ['DELETE'])
@@ -211,20 +282,28 @@ def delete_user(id):
     
     """
     u = User.query.get_or_404(id)
+    reviews = ['review:{}'.format(r.id) for r in u.reviews]
     db.session.delete(u)
+    TableVersion.bump('user', 'review', 'favorites')
+    invalidate_cache('users', 'user:{}'.format(id), 'favorites', 'favorites:{}'.format(id),\
+            *reviews)
     db.session.commit()
+    credential_cache.invalidate(id)
+    User.revoke_auth_tokens(id)
     return jsonify({'results': True, 'status': 'User deleted successfully'})
 
 
 
 # Glass model routes
 @app.route('/beer/api/v0.1/glasses', methods = ['GET'])
+@conditional('glass', 'beer', 'review')
+@cached('glasses')
 def list_glasses():
     """ List glass types in the database.
 
     |  **URL:** /beer/api/v0.1/glasses
     |  **Method:** GET
-    |  **Query Args:** sort_by=<column name> <desc>
+    |  **Query Args:** sort_by=<column_name> <desc>, limit=<page size>, after=<cursor>, stream=true
     |  **Authentication:** None
 
     Example:
@@ -236,20 +315,20 @@ def list_glasses():
     *List glass styles by name descending* ::
 
       GET http://domain.tld/beer/api/v0.1/glasses?sort_by=name%20desc
-    
+
+    *Fetch the next page of glass styles, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/glasses?limit=20&after=<cursor>
+
     """
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            glasses = Glass.query.order_by(sort).all()
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    else:
-        glasses = Glass.query.all()
-    return jsonify(results=[g.serialize() for g in glasses])
+    if wants_stream():
+        return stream_results(Glass.query, Glass, Glass.serialize_all)
+    glasses, next = paginate(Glass.query, Glass, 'list_glasses')
+    return jsonify(results=Glass.serialize_all(glasses), next=next)
 
 @app.route('/beer/api/v0.1/glasses/<int:id>', methods = ['GET'])
+@conditional('glass', 'beer', 'review')
+@cached()
 def get_glass(id):
     """ Get data about a particular glass in the database.
 
@@ -297,6 +376,8 @@ def create_glass():
         abort(400)
     glass = Glass(name)
     db.session.add(glass)
+    TableVersion.bump('glass')
+    invalidate_cache('glasses')
     db.session.commit()
     return jsonify({'results': glass.serialize(),\
             'status': 'Glass-type created successfully'}), 201,\
@@ -332,6 +413,9 @@ def edit_glass(id):
             flash(u'Glass with that name already exists', 'error')
             abort(400)
         g.name = name
+    TableVersion.bump('glass')
+    invalidate_cache('glasses', 'glass:{}'.format(id),\
+            *['beer:{}'.format(b.id) for b in g.beers])
     db.session.commit()
     return jsonify({'status': 'Glass-type updated successfully',\
             'results': g.serialize()})
@@ -355,7 +439,10 @@ def delete_glass(id):
     """
 
     g = Glass.query.get_or_404(id)
+    beers = ['beer:{}'.format(b.id) for b in g.beers]
     db.session.delete(g)
+    TableVersion.bump('glass', 'beer')
+    invalidate_cache('glasses', 'glass:{}'.format(id), 'beers', *beers)
     db.session.commit()
     return jsonify({'results': True, 'status': 'Glass deleted successfully'})
 
@@ -364,12 +451,15 @@ def delete_glass(id):
 
 # Beer model routes
 @app.route('/beer/api/v0.1/beers', methods = ['GET'])
+@conditional('beer', 'review')
+@cached('beers')
 def list_beers():
     """ List all of the beers in the database.
 
     |  **URL:** /beer/api/v0.1/beers
     |  **Method:** GET
-    |  **Query Args:** sort_by=<column_name> <desc>
+    |  **Query Args:** sort_by=<id|name|brewer|style|abv|ibu|calories> <desc>, limit=<page size>, after=<cursor>, stream=true
+    |  **Filters:** abv_min, abv_max, ibu_min, ibu_max, calories_min, calories_max, style, brewer, glass_type
     |  **Authentication:** None
 
     Example:
@@ -386,19 +476,115 @@ def list_beers():
 
       GET http://domain.tld/beer/api/v0.1/beers?sort_by=calories%20desc
 
+    *Strongest IPAs under 60 IBU* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers?style=IPA&ibu_max=60&sort_by=abv%20desc
+
+    *Fetch the next page of beers, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers?limit=20&after=<cursor>
+
+    *Stream every beer in one chunked response instead of pages* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers?stream=true
+
     """
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            beers = Beer.query.order_by(sort).all()
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    else:
-        beers = Beer.query.all()
-    return jsonify(results=[b.serialize() for b in beers])
+    if wants_stream():
+        return stream_results(Beer.query, Beer)
+    if app.config['READ_MODEL_ENABLED']:
+        page = catalog.page()
+        if page is not None:
+            rows, next = page
+            return jsonify(results=serialize_page(rows), next=next)
+    beers, next = paginate(Beer.query, Beer, 'list_beers')
+    return jsonify(results=Beer.schema.serialize_all(beers), next=next)
+
+@app.route('/beer/api/v0.1/beers/top', methods = ['GET'])
+@conditional('beer', 'review')
+@cached('beers', 'reviews')
+def list_top_beers():
+    """ Leaderboard of the best rated beers in a score category.
+
+    Rankings come from the averages stored with each beer's score totals,
+    which are updated with every review, so reading a leaderboard never
+    touches the reviews table. Beers with fewer than min_reviews reviews
+    are left out so a single perfect review doesn't top the list.
+
+    |  **URL:** /beer/api/v0.1/beers/top
+    |  **Method:** GET
+    |  **Query Args:** category=<aroma|appearance|taste|palate|bottle_style|overall>, n=<number of beers>, min_reviews=<count>
+    |  **Authentication:** None
+
+    Example:
+
+    *The 50 best tasting beers* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/top?category=taste&n=50
+
+    *Best beers overall, counting beers with at least 20 reviews* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/top?min_reviews=20
+
+    """
+    category = request.args.get('category') or 'overall'
+    if category not in BeerScore.rankings:
+        flash(u'Invalid category specified', 'error')
+        abort(400)
+    n = request.args.get('n') or str(app.config['TOP_DEFAULT_SIZE'])
+    min_reviews = request.args.get('min_reviews') or str(app.config['TOP_MIN_REVIEWS'])
+    if not n.isdigit() or int(n) < 1 or not min_reviews.isdigit():
+        flash(u'Invalid n or min_reviews specified', 'error')
+        abort(400)
+    beers = BeerScore.top_query(category, min(int(n), app.config['API_MAX_PAGE_SIZE']),\
+            max(int(min_reviews), 1)).all()
+    return jsonify(category=category, results=[dict(serial, rank=rank,\
+            score=getattr(b.scores, category + '_average'), review_count=b.scores.review_count)\
+            for rank, (b, serial) in enumerate(zip(beers, Beer.schema.serialize_all(beers)), 1)])
+
+@app.route('/beer/api/v0.1/beers/search', methods = ['GET'])
+@conditional('beer', 'review')
+@cached('beers')
+def search_beers():
+    """ Search beers by name, brewer, style and brew location, best matches first.
+
+    Every word must match (words match as prefixes). Results come from the
+    full-text index ranked by relevance, on databases without it they fall
+    back to a slower substring search ordered like /beers.
+
+    |  **URL:** /beer/api/v0.1/beers/search
+    |  **Method:** GET
+    |  **Query Args:** q=<search words>, limit=<page size>, after=<cursor>
+    |  **Authentication:** None
+
+    Example:
+
+    *Find amber ales brewed by New Belgium* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/search?q=new%20belgium%20amber
+
+    *Fetch the next page of results (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/search?q=amber&after=<cursor>
+
+    """
+    terms = search_terms(request.args.get('q'))
+    if not terms:
+        flash(u'Missing search query, expecting \'q\'', 'error')
+        abort(400)
+    if not search_index_exists():
+        beers, next = paginate(like_search(terms), Beer, 'search_beers')
+        return jsonify(results=Beer.schema.serialize_all(beers), next=next)
+    beers, cursor = search(terms, page_size(), request.args.get('after') or None)
+    next = None
+    if cursor is not None:
+        args = request.args.to_dict()
+        args['after'] = cursor
+        next = url_for('search_beers', _external=True, **args)
+    return jsonify(results=Beer.schema.serialize_all(beers), next=next)
 
 @app.route('/beer/api/v0.1/beers/<int:id>', methods = ['GET'])
+@conditional('beer', 'review')
+@cached()
 def get_beer(id):
     """ Get data about a particular beer.
 
@@ -417,13 +603,49 @@ def get_beer(id):
     b = Beer.query.get_or_404(id)
     return jsonify(results=b.serialize())
 
+@app.route('/beer/api/v0.1/beers/<int:id>/similar', methods = ['GET'])
+@conditional('beer', 'review')
+@cached('beers')
+def get_similar_beers(id):
+    """ Beers closest to a particular beer in abv, ibu, calories, style and glass type.
+
+    Distances are computed over the whole catalog at once by an in-memory
+    feature matrix that write routes keep up to date. Beers without a
+    value for a numeric attribute are treated as average for it.
+
+    |  **URL:** /beer/api/v0.1/beers/<beer_id>/similar
+    |  **Method:** GET
+    |  **Query Args:** n=<number of beers>
+    |  **Authentication:** None
+
+    Example:
+
+    *The 5 beers most like beer with id# 5* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/5/similar?n=5
+
+    """
+    b = Beer.query.get_or_404(id)
+    n = request.args.get('n') or str(app.config['SIMILAR_DEFAULT_SIZE'])
+    if not n.isdigit() or int(n) < 1:
+        flash(u'Invalid n specified', 'error')
+        abort(400)
+    nearest = similar_index.nearest(b.id, min(int(n), app.config['API_MAX_PAGE_SIZE']))
+    beers = dict((s.id, s) for s in Beer.query.filter(Beer.id.in_([id for id, d in nearest])))\
+            if nearest else {}
+    nearest = [(beers[id], distance) for id, distance in nearest if id in beers]
+    return jsonify(results=[dict(serial, distance=distance) for serial, (s, distance)\
+            in zip(Beer.schema.serialize_all([s for s, distance in nearest]), nearest)])
+
 @app.route('/beer/api/v0.1/beers/<int:id>/reviews', methods = ['GET'])
+@conditional('beer', 'review')
+@cached()
 def get_beer_reviews(id):
     """ Return list of reviews about a particular beer.
 
     |  **URL:** /beer/api/v0.1/beers/<beer_id>/reviews
     |  **Method:** GET
-    |  **Query Args:** None
+    |  **Query Args:** sort_by=<column_name> <desc>, limit=<page size>, after=<cursor>, stream=true
     |  **Authentication:** None
 
     Example:
@@ -432,22 +654,22 @@ def get_beer_reviews(id):
 
       GET http://domain.tld/beer/api/v0.1/beers/2/reviews
 
-    *Get reviews of beer with id# 4 sorted by taste descending* ::
+    *Get reviews of beer with id# 4, newest first* ::
       
-      GET http://domain.tld/beer/api/v0.1/beers/4/reviews?sort_by=taste desc
+      GET http://domain.tld/beer/api/v0.1/beers/4/reviews?sort_by=created_on desc
+
+    *Fetch the next page of reviews, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/beers/4/reviews?limit=20&after=<cursor>
 
     """
 
     b = Beer.query.get_or_404(id)
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            return jsonify(results=\
-                    [r.serialize() for r in  b.reviews.order_by(sort)])
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    return jsonify(results=[r.serialize() for r in b.reviews])
+    cache_tag('beer:{}'.format(id))
+    if wants_stream():
+        return stream_results(b.reviews, Review)
+    reviews, next = paginate(b.reviews, Review, 'get_beer_reviews', id=id)
+    return jsonify(results=Review.schema.serialize_all(reviews), next=next)
 
 @app.route('/beer/api/v0.1/beers', methods = ['POST'])
 @auth.login_required
@@ -507,11 +729,110 @@ def create_beer():
             beer.glass_type_id = gid
 
     db.session.add(beer)
-    db.session.commit()
     g.user.last_beer_added = datetime.utcnow()
+    TableVersion.bump('beer')
+    version = beer_version()
+    invalidate_cache('beers', *glass_tags(beer.glass_type_id))
+    db.session.commit()
+    similar_index.upsert([feature_row(beer)], version)
+    catalog.upsert([beer.id], version)
     return jsonify({'results': beer.serialize(), 'status': 'Beer created successfully'}),\
             201, {'Location':url_for('get_beer', id=beer.id, _external=True)}
 
+@app.route('/beer/api/v0.1/beers/batch', methods = ['POST'])
+@auth.login_required
+def create_beers():
+    """ Add a list of beers to the database in a single transaction.
+
+    Each beer is checked like in create_beer, but duplicate names and glass
+    types are looked up for the whole list at once. Valid beers are
+    inserted together, the rest are reported per item. A batch counts as
+    the user's beer addition for the day.
+
+    |  **URL:** /beer/api/v0.1/beers/batch
+    |  **Method:** POST
+    |  **Query Args:** None
+    |  **Authentication:** Token/Password
+    |  **Expected Data:** beers (list of beers, each with name, style, abv)
+    |  **Optional Data:** brewer, ibu, calories, brew_location, glass_type (per beer)
+
+    Example:
+
+    *Create two beers from the same brewery, the second linked to glass_type 2* ::
+
+      POST http://domain.tld/beer/api/v0.1/beers/batch
+      data={"beers":[{"name":"Spotted Cow", "style":"Cream Ale", "abv":4.8, "brewer":"New Glarus"},
+            {"name":"Moon Man", "style":"Pale Ale", "abv":5.0, "brewer":"New Glarus", "glass_type":2}]}
+
+    """
+    if g.user.last_beer_added and \
+            (datetime.utcnow() - g.user.last_beer_added) < timedelta(days=1):
+        # Beer already created in last 24 hours
+        flash(u'You\'ve already added a beer today.', 'error')
+        abort(400)
+    beers = request.json.get('beers')
+    if type(beers) != list or not beers:
+        flash(u'Invalid input, expecting \'beers\' list.', 'error')
+        abort(400)
+    if len(beers) > app.config['BULK_MAX_ITEMS']:
+        flash(u'Too many beers, the limit is {}'.format(app.config['BULK_MAX_ITEMS']), 'error')
+        abort(400)
+
+    items = [(item if type(item) == dict else {}) for item in beers]
+    names = set(item.get('name') for item in items if type(item.get('name')) == str)
+    taken = set(name for (name,) in db.session.query(Beer.name).filter(Beer.name.in_(names)))\
+            if names else set()
+    glasses = existing_ids(Glass, [parse_id_or_uri(item['glass_type'])\
+            for item in items if item.get('glass_type') is not None])
+
+    results, rows = [], []
+    for index, item in enumerate(items):
+        name = item.get('name')
+        glass_type_id = item.get('glass_type')
+        if glass_type_id is not None:
+            glass_type_id = parse_id_or_uri(glass_type_id)
+        if name is None or item.get('style') is None or item.get('abv') is None:
+            error = u'Missing required field (name, style, abv)'
+        elif type(name) != str:
+            error = u'Invalid input'
+        elif name in taken:
+            error = u'Beer already exists'
+        elif item.get('glass_type') is not None and glass_type_id not in glasses:
+            error = u'Invalid glass_type specified'
+        else:
+            error = None
+        if error is not None:
+            results.append({'index': index, 'status': 'error', 'error': error})
+            continue
+        taken.add(name)
+        rows.append({'name': name, 'brewer': item.get('brewer'), 'ibu': item.get('ibu'),\
+                'calories': item.get('calories'), 'abv': item.get('abv'),\
+                'style': item.get('style'), 'brew_location': item.get('brew_location'),\
+                'glass_type_id': glass_type_id})
+        results.append({'index': index, 'name': name, 'status': 'created'})
+    if not rows:
+        return jsonify({'results': results, 'status': 'No beers created'}), 400
+
+    db.session.execute(Beer.__table__.insert(), rows)
+    ids = dict(db.session.query(Beer.name, Beer.id)\
+            .filter(Beer.name.in_([row['name'] for row in rows])))
+    totals = dict((category, 0) for category in BeerScore.categories)
+    db.session.execute(BeerScore.__table__.insert(), [dict(totals, beer_id=ids[row['name']],\
+            review_count=0) for row in rows])
+    g.user.last_beer_added = datetime.utcnow()
+    TableVersion.bump('beer')
+    version = beer_version()
+    invalidate_cache('beers', *glass_tags(*[row['glass_type_id'] for row in rows]))
+    db.session.commit()
+    similar_index.upsert([(ids[row['name']], row['abv'], row['ibu'], row['calories'],\
+            row['style'], row['glass_type_id']) for row in rows], version)
+    catalog.upsert(list(ids.values()), version)
+    for result in results:
+        if result['status'] == 'created':
+            result['link'] = url_for('get_beer', id=ids[result['name']], _external=True)
+    return jsonify({'results': results, 'status': '{} of {} beers created'\
+            .format(len(rows), len(items))}), 201
+
 @app.route('/beer/api/v0.1/beers/<int:id>', methods = ['PUT'])
 @auth.login_required
 def edit_beer(id):
@@ -537,6 +858,7 @@ def edit_beer(id):
 
     """
     b = Beer.query.get_or_404(id)
+    old_glass_type_id = b.glass_type_id
     if 'name' in request.json and type(request.json['name']) not in [str, int]:
         flash(u'Invalid input', 'error')
         abort(400)
@@ -590,7 +912,13 @@ def edit_beer(id):
         b.style = style
     if brew_location is not None:
         b.brew_location = brew_location
+    TableVersion.bump('beer')
+    version = beer_version()
+    invalidate_cache('beers', 'beer:{}'.format(id),\
+            *glass_tags(old_glass_type_id, b.glass_type_id))
     db.session.commit()
+    similar_index.upsert([feature_row(b)], version)
+    catalog.upsert([id], version)
     return jsonify({'status': 'Beer updated successfully', 'results': b.serialize()})
 
 @app.route('/beer/api/v0.1/beers/<int:id>', methods= ['DELETE'])
@@ -611,8 +939,15 @@ def delete_beer(id):
 
     """
     b = Beer.query.get_or_404(id)
+    reviews = ['review:{}'.format(r.id) for r in b.reviews]
     db.session.delete(b)
+    TableVersion.bump('beer', 'review', 'favorites')
+    version = beer_version()
+    invalidate_cache('beers', 'beer:{}'.format(id), 'reviews',\
+            *(glass_tags(b.glass_type_id) + reviews))
     db.session.commit()
+    similar_index.remove([id], version)
+    catalog.remove([id], version)
     return jsonify({'results':True, 'status': 'Beer deleted successfully'})
 
 
@@ -620,12 +955,15 @@ def delete_beer(id):
 
 # Review model routes
 @app.route('/beer/api/v0.1/reviews', methods = ['GET'])
+@conditional('review')
+@cached('reviews')
 def list_reviews():
     """ Return a list of all reviews in the database.
 
     |  **URL:** /beer/api/v0.1/reviews
     |  **Method:** GET
-    |  **Query Args:** sort_by=<column_name> <desc>
+    |  **Query Args:** sort_by=<id|created_on> <desc>, limit=<page size>, after=<cursor>, stream=true
+    |  **Filters:** beer=<id or link>, author=<id or link>, created_after=<date>, created_before=<date>
     |  **Authentication:** None
 
     Examples:
@@ -634,23 +972,23 @@ def list_reviews():
 
       GET http://domain.tld/beer/api/v0.1/reviews
 
-    *List reviews sorted by aroma rating* ::
+    *List reviews written since March 2014, newest first* ::
+
+      GET http://domain.tld/beer/api/v0.1/reviews?created_after=2014-03-01&sort_by=created_on%20desc
 
-      GET http://domain.tld/beer/api/v0.1/reviews?sort_by=aroma
+    *Fetch the next page of reviews, 20 at a time (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/reviews?limit=20&after=<cursor>
 
     """
-    sort = request.args.get('sort_by') or None
-    if sort:
-        try:
-            reviews = Review.query.order_by(sort).all()
-        except OperationalError:
-            flash(u'Invalid sorting value specified', 'error')
-            abort(400)
-    else:
-        reviews = Review.query.all()
-    return jsonify(results=[r.serialize() for r in reviews])
+    if wants_stream():
+        return stream_results(Review.query, Review)
+    reviews, next = paginate(Review.query, Review, 'list_reviews')
+    return jsonify(results=Review.schema.serialize_all(reviews), next=next)
 
 @app.route('/beer/api/v0.1/reviews/<int:id>', methods = ['GET'])
+@conditional('review')
+@cached()
 def get_review(id):
     """ Return data about a specific review.
 
@@ -712,21 +1050,57 @@ def create_review():
                 flash(u'That beer does not exist, please create it first', 'error')
                 abort(400)
             # Has user reviewed that beer this week?
-            for review in g.user.reviews:
-                if review.beer_id == bid:
-                    if (datetime.utcnow() - review.created_on) < timedelta(weeks=1):
-                        flash(u'You have already reviewed that beer this week!', 'error')
-                        abort(400)
+            if Review.reviewed_since(g.user.id, bid, datetime.utcnow() - timedelta(weeks=1)):
+                flash(u'You have already reviewed that beer this week!', 'error')
+                abort(400)
     if not Review.validate_score_values(score):
         flash(u'Invalid score data, please try again', 'error')
         abort(400)
     review = Review(bid, g.user.id, score)
     db.session.add(review)
+    BeerScore.adjust(bid, score, count=1)
+    TableVersion.bump('review')
+    invalidate_cache('reviews', 'beer:{}'.format(bid), 'user:{}'.format(g.user.id))
     db.session.commit()
     return(jsonify({'results': review.serialize(), \
             'status': 'Review created successfully'}), 201, \
             {'Location': url_for('get_review', id=review.id, _external=True)})
 
+@app.route('/beer/api/v0.1/reviews/import', methods = ['POST'])
+@auth.login_required
+def import_user_reviews():
+    """ Import reviews in bulk from newline-delimited JSON, one review per line.
+
+    The body is read as a stream and imported in chunks of IMPORT_CHUNK_SIZE
+    records, each chunk validated at once and committed in its own
+    transaction. Every review is imported as the authenticated user,
+    records that fail validation are listed in the returned error report.
+
+    |  **URL:** /beer/api/v0.1/reviews/import
+    |  **Method:** POST
+    |  **Query Args:** None
+    |  **Authentication:** Token/Password
+    |  **Content-Type:** application/x-ndjson
+    |  **Expected Data:** beer_id, aroma, appearance, taste, palate, bottle_style (per line)
+    |  **Optional Data:** created_on (ISO 8601, per line)
+
+    Example:
+
+    *Import two reviews written elsewhere* ::
+
+      POST http://domain.tld/beer/api/v0.1/reviews/import
+      {"beer_id":4, "aroma":3, "appearance":3, "taste":8, "palate":4, "bottle_style":1, "created_on":"2014-03-01T18:30:00"}
+      {"beer_id":"http://domain.tld/beer/api/v0.1/beers/2", "aroma":1, "appearance":1, "taste":5, "palate":5, "bottle_style":5}
+
+    """
+    if request.mimetype != 'application/x-ndjson':
+        flash(u'Invalid request, expecting NDJSON', 'error')
+        abort(400)
+    imported, errors = import_reviews(request.stream, author_id=g.user.id)
+    return jsonify({'imported': imported, 'errors': errors,\
+            'status': '{} reviews imported, {} rejected'.format(imported, len(errors))}),\
+            201 if imported else 400
+
 @app.route('/beer/api/v0.1/reviews/<int:id>', methods = ['PUT'])
 @auth.login_required
 def edit_review(id):
@@ -758,7 +1132,14 @@ def edit_review(id):
     if not r.validate_score_values(data):
         flash(u'Unable to validate new scores', 'error')
         abort(400)
+    old_scores = r.score_values()
     r.update_score_values(data)
+    new_scores = r.score_values()
+    BeerScore.adjust(r.beer_id, dict((category, new_scores[category] - old_scores[category])\
+            for category in BeerScore.categories))
+    TableVersion.bump('review')
+    invalidate_cache('reviews', 'review:{}'.format(id), 'beer:{}'.format(r.beer_id),\
+            'user:{}'.format(r.author_id))
     db.session.commit()
     return(jsonify({'results': r.serialize(), 'status': 'Review updated successfully'}))
 
@@ -781,11 +1162,18 @@ def delete_review(id):
     """
     r = Review.query.get_or_404(id)
     db.session.delete(r)
+    BeerScore.adjust(r.beer_id, dict((category, -value)\
+            for category, value in r.score_values().items()), count=-1)
+    TableVersion.bump('review')
+    invalidate_cache('reviews', 'review:{}'.format(id), 'beer:{}'.format(r.beer_id),\
+            'user:{}'.format(r.author_id))
     db.session.commit()
     return jsonify({'results': True, 'status': 'Review deleted successfully'})
 
 # Favorites list routes
 @app.route('/beer/api/v0.1/users/<int:id>/favorites', methods = ['GET'])
+@conditional('user', 'favorites', 'beer', 'review')
+@cached()
 def get_user_favorites(id):
     """ Return a list of users favorite beers.
 
@@ -803,7 +1191,8 @@ def get_user_favorites(id):
     """
 
     u = User.query.get_or_404(id)
-    return jsonify(results=[b.serialize() for b in u.favorites])
+    cache_tag('favorites:{}'.format(id))
+    return jsonify(results=Beer.schema.serialize_all(u.favorites))
 
 @app.route('/beer/api/v0.1/users/<int:id>/favorites', methods = ['POST'])
 @auth.login_required
@@ -823,23 +1212,41 @@ def create_user_favorites_list(id):
       POST http://domain.tld/beer/api/v0.1/users/5/favorites
       data={"beers":["2", 6, 3, "http://domain.tld/beer/api/v0.1/beers/19"]}
 
+    The beers are looked up with a single query and the list is stored in
+    one statement, the response lists each beer's name and link (GET the
+    list for the full beer details).
+
     """
     u = User.query.get_or_404(id)
-    if u.favorites != []:
+    if db.session.query(favorite.c.beer_id).filter(favorite.c.user_id == id).first():
         flash(u'User already has a favorites list, delete it first', 'error')
         abort(400)
-    if not "beers" in request.json:
+    if not "beers" in request.json or type(request.json['beers']) != list:
         flash(u'Invalid input, expecting \'beers\' list.')
         abort(400)
+    if len(request.json['beers']) > app.config['BULK_MAX_ITEMS']:
+        flash(u'Too many beers, the limit is {}'.format(app.config['BULK_MAX_ITEMS']), 'error')
+        abort(400)
+    ids = []
     for beer in request.json['beers']:
-        if not Beer.id_or_uri_check(beer):
+        bid = parse_id_or_uri(beer)
+        if bid is None:
             flash(u'Invalid beer ID/URL specified', 'error')
             abort(400)
-        b = Beer.query.get(beer)
-        u.add_to_favorites(b)
-        db.session.commit()
-    return jsonify({"results": [b.serialize() for b in u.favorites],\
-            'status': 'Favorites list created with ' + str(len(u.favorites))\
+        if bid not in ids:
+            ids.append(bid)
+    names = dict(db.session.query(Beer.id, Beer.name).filter(Beer.id.in_(ids))) if ids else {}
+    if len(names) != len(ids):
+        flash(u'Invalid beer ID/URL specified', 'error')
+        abort(400)
+    if ids:
+        db.session.execute(favorite.insert(), [{'user_id': id, 'beer_id': bid} for bid in ids])
+    TableVersion.bump('favorites')
+    invalidate_cache('favorites', 'favorites:{}'.format(id))
+    db.session.commit()
+    return jsonify({"results": [{'name': names[bid], 'link': url_for('get_beer', id=bid,\
+            _external=True)} for bid in ids],\
+            'status': 'Favorites list created with ' + str(len(ids))\
             + ' beers'}), 201
 
 @app.route('/beer/api/v0.1/users/<int:id>/favorites', methods = ['PUT'])
@@ -895,8 +1302,10 @@ def edit_user_favorites(id):
             flash(u'Beer wasn\'t on the favorite list anyway', 'error')
             abort(400)
         u.remove_from_favorites(beer)
+    TableVersion.bump('favorites')
+    invalidate_cache('favorites', 'favorites:{}'.format(id))
     db.session.commit()
-    return jsonify({'results': [b.serialize() for b in u.favorites],\
+    return jsonify({'results': Beer.schema.serialize_all(u.favorites),\
             'status': ''+beer.name+' '+('added to' if action == 'add'\
             else 'removed from')+' favorites'})
 
@@ -921,17 +1330,25 @@ def delete_users_favorites_list(id):
     if u.favorites == []:
         return jsonify({'results': False, 'status': 'Favorites list was already empty'})
     u.favorites = []
+    TableVersion.bump('favorites')
+    invalidate_cache('favorites', 'favorites:{}'.format(id))
     db.session.commit()
     return jsonify({'results': True, 'status': 'Favorites list deleted successfully'})
 
 @app.route('/beer/api/v0.1/favorites', methods = ['GET'])
 @auth.login_required
+@conditional('user', 'favorites', 'beer', 'review')
+@cached('favorites', 'users')
 def list_all_user_favorites():
-    """ List favorites list for each user in database.
+    """ List favorites list for each user in database, a page of users at a time.
+
+    The favorites of a whole page are fetched with one query joining
+    favorites to beers, and each beer is serialized once no matter how many
+    users on the page share it.
 
     |  **URL:** /beer/api/v0.1/favorites
     |  **METHOD:** GET
-    |  **Query Args:** None
+    |  **Query Args:** sort_by=<user column> <desc>, limit=<page size>, after=<cursor>
     |  **Authentication:** Token/Password
 
     Example:
@@ -940,44 +1357,136 @@ def list_all_user_favorites():
 
       GET http://domain.tld/beer/api/v0.1/favorites
 
+    *Fetch the next page of users (use the 'next' link from the previous page)* ::
+
+      GET http://domain.tld/beer/api/v0.1/favorites?after=<cursor>
+
     """
 
-    users = User.query.all()
-    return jsonify({'results': \
-            [{u.username: [b.serialize() for b in u.favorites]} for u in users]})
+    users, next = paginate(User.query, User, 'list_all_user_favorites')
+    favorites = load_user_favorites(set(u.id for u in users)) if users else {}
+    beers = dict((b.id, b) for found in favorites.values() for b in found)
+    docs = dict(zip(beers, Beer.schema.serialize_all(list(beers.values()))))
+    return jsonify({'results': [{u.username: [docs[b.id] for b in favorites.get(u.id, [])]}\
+            for u in users], 'next': next})
 
 
-    
+
+# Statistics routes
+@app.route('/beer/api/v0.1/stats', methods = ['GET'])
+@conditional('beer', 'review')
+def get_stats():
+    """ Summary statistics of the beer catalog and its reviews.
+
+    Returns histograms, percentiles and means of abv, ibu and calories,
+    averages per style, and how often each score was given in reviews.
+    The columns are loaded into arrays and aggregated in one pass, the
+    result is kept until a beer or review is written.
+
+    |  **URL:** /beer/api/v0.1/stats
+    |  **Method:** GET
+    |  **Query Args:** bins=<histogram bin count>
+    |  **Authentication:** None
+
+    Example:
+
+    *Catalog statistics with 20 bins per histogram* ::
+
+      GET http://domain.tld/beer/api/v0.1/stats?bins=20
+
+    """
+    bins = request.args.get('bins') or str(app.config['STATS_HISTOGRAM_BINS'])
+    if not bins.isdigit() or int(bins) < 1 or int(bins) > app.config['STATS_MAX_BINS']:
+        flash(u'Invalid bins specified', 'error')
+        abort(400)
+    return jsonify(results=catalog_stats(int(bins)))
+
+# Response cache routes
+@app.route('/beer/api/v0.1/cache', methods = ['GET'])
+@auth.login_required
+def get_cache_stats():
+    """ Return hit/miss counters and memory use of this worker's response cache.
+
+    |  **URL:** /beer/api/v0.1/cache
+    |  **Method:** GET
+    |  **Query Args:** None
+    |  **Authentication:** Token/Password
+
+    Example:
+
+    *Get response cache statistics* ::
+
+      GET http://domain.tld/beer/api/v0.1/cache
+
+    """
+
+    return jsonify(results=response_cache.stats())
+
 
 '''
 *** Authentication
 '''
+# Recently verified Basic-auth credentials, credential_key() -> (user id, password hash)
+credential_cache = TTLCache(app.config['CREDENTIAL_CACHE_SIZE'],\
+        app.config['CREDENTIAL_CACHE_TTL'])
+
+def credential_key(username, password):
+    """ Returns a keyed hash of a username/password pair, so plaintext passwords are never kept in memory. """
+    message = u'{}\x00{}'.format(username, password).encode('utf-8')
+    return hmac.new(app.config['SECRET_KEY'].encode('utf-8'), message, hashlib.sha256).hexdigest()
+
 @auth.verify_password
 def verify_password(username, password):
-    """ Returns true if hash of plaintext 'password' equals stored password hash for user. """
+    """ Returns true if hash of plaintext 'password' equals stored password hash for user.
+
+    Credentials verified within the last CREDENTIAL_CACHE_TTL seconds skip the
+    (deliberately slow) hash. A cached entry only counts while the user's stored
+    hash is unchanged, so password changes made by other workers still apply.
+
+    """
 
     user = User.check_auth_token(username)
     if not user:
-        user = User.query.filter_by(username=username).first()
-        if not user or not user.check_password(password):
-            return False
+        key = credential_key(username, password)
+        cached = credential_cache.get(key)
+        if cached is not None:
+            user = User.query.get(cached[0])
+            if user and (user.username != username or user.password != cached[1]):
+                user = None
+        if not user:
+            user = User.query.filter_by(username=username).first()
+            if not user or not user.check_password(password):
+                return False
+            credential_cache.set(key, (user.id, user.password), tag=user.id)
     g.user = user
     return True
 
 @app.before_request
 def before_request():
-    """ Checks for *Content-Type: application/json* on all POST/PUT/DELETE routes. """
-    if request.method != "GET" and request.json == None:
+    """ Checks for *Content-Type: application/json* on all POST/PUT/DELETE routes.
+
+    Bulk imports stream *application/x-ndjson* instead and are let through.
+
+    """
+    if request.method != "GET" and request.mimetype != 'application/x-ndjson' and\
+            request.json == None:
         flash(u'Invalid request, expecting JSON')
         abort(400)
 
 @app.after_request
 def after_request(response):
-    """ Update a users last_activity field after each authenticated api request. """
+    """ Record a users last_activity after each authenticated api request.
+
+    Timestamps are buffered and written in batches every ACTIVITY_FLUSH_INTERVAL
+    seconds by a background thread, so no request has to commit them. After a successful write
+    the client's reads stick to the primary database for a while.
+
+    """
 
     if 'user' in g:
-        g.user.last_activity = datetime.utcnow()
-        db.session.commit()
+        activity.touch(g.user.id)
+    if request.method not in READ_METHODS and response.status_code < 400:
+        db.mark_writer(response)
     return response
 
 
@@ -998,6 +1507,12 @@ def malformed_error(error):
         return jsonify(errors), 400
     return jsonify({"error": "400: Malformed request"}), 400
 
+@app.errorhandler(401)
+def unauthenticated_error(error):
+    """ Return a 401 error when the user behind a validated token has since been deleted. """
+
+    return jsonify({"error": "401: Unauthenticated"}), 401
+
 @app.errorhandler(404)
 def not_found_error(error):
     """ Return a 404 error, usually when <int:id> in the route is not a valid id# for that model. """
@@ -0,0 +1,152 @@
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from app import db
+from app.models import User, Glass, Beer, BeerScore, Review, CacheInvalidation, favorite
+from app.search import create_search_index
+
+def missing_indexes(engine=None):
+    """ Returns the indexes declared on the models that don't exist in the database yet. """
+    inspector = inspect(engine or db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+def missing_columns(engine=None):
+    """ Returns the columns declared on the models that existing tables don't have yet. """
+    inspector = inspect(engine or db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        missing.extend(c for c in table.columns if c.name not in existing)
+    return missing
+
+def upgrade(engine=None):
+    """ Brings an existing database up to the current models, returns the names of what was added.
+
+    New tables are created with their indexes by create_all(), columns and
+    indexes added to existing tables (and the beer search index) are created
+    here. New score columns are filled in from the reviews. Safe to run
+    repeatedly.
+
+    """
+    engine = engine or db.engine
+    db.create_all()
+    created = []
+    for column in missing_columns(engine):
+        engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(column.table.name,\
+                CreateColumn(column).compile(dialect=engine.dialect)))
+        created.append('{}.{}'.format(column.table.name, column.name))
+    if any(name.startswith(BeerScore.__tablename__ + '.') for name in created):
+        BeerScore.rebuild()
+        db.session.commit()
+    for index in missing_indexes(engine):
+        index.create(engine)
+        created.append(index.name)
+    if create_search_index(engine):
+        created.append('beer_fts')
+    return created
+
+# Query name -> function building one of the app's hot queries
+hot_queries = {}
+
+def hot_query(name):
+    """ Decorator registering a function that builds a hot query to check with check_plans().
+
+    The function takes no arguments and returns a Query or selectable, bound
+    parameter values don't matter as only the plan is looked at.
+
+    """
+    def decorator(f):
+        hot_queries[name] = f
+        return f
+    return decorator
+
+def query_plan(query, engine=None):
+    """ Returns the EXPLAIN QUERY PLAN detail lines for 'query'. """
+    engine = engine or db.engine
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    rows = engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), *params)
+    return [row['detail'] for row in rows]
+
+def scans_table(detail):
+    """ Returns True if a query plan line reads a whole table without an index. """
+    words = detail.split()
+    if len(words) < 2 or words[0] != 'SCAN' or 'INDEX' in words:
+        return False
+    table = words[2] if words[1] == 'TABLE' else words[1]
+    return table in db.metadata.tables
+
+def check_plans(engine=None):
+    """ Returns {query name: plan} for every hot query that scans a table without an index. """
+    scans = {}
+    for name, build in sorted(hot_queries.items()):
+        plan = query_plan(build(), engine)
+        if any(scans_table(detail) for detail in plan):
+            scans[name] = plan
+    return scans
+
+@hot_query('beer.reviews')
+def beer_reviews_query():
+    return Review.query.filter(Review.beer_id == 1).order_by(Review.id)
+
+@hot_query('user.reviews')
+def user_reviews_query():
+    return Review.query.filter(Review.author_id == 1).order_by(Review.id)
+
+@hot_query('review.reviewed_since')
+def reviewed_since_query():
+    return db.session.query(Review.id).filter(Review.author_id == 1, Review.beer_id == 1,\
+            Review.created_on > datetime.utcnow())
+
+@hot_query('review.created_on')
+def recent_reviews_query():
+    return Review.query.filter(Review.created_on > datetime.utcnow()).order_by(Review.created_on)
+
+@hot_query('cache_invalidation.prune')
+def prune_invalidations_query():
+    table = CacheInvalidation.__table__
+    return table.select().where(table.c.created_on < datetime.utcnow())
+
+@hot_query('glass.beers')
+def glass_beers_query():
+    return Beer.query.filter(Beer.glass_type_id.in_([1, 2])).order_by(Beer.id)
+
+@hot_query('user.favorites')
+def user_favorites_query():
+    return db.session.query(favorite.c.user_id, Beer).select_from(favorite)\
+            .join(Beer, favorite.c.beer_id == Beer.id).filter(favorite.c.user_id.in_([1, 2]))
+
+@hot_query('beer.favorites')
+def beer_favorites_query():
+    return db.session.query(favorite.c.user_id).filter(favorite.c.beer_id == 1)
+
+def sorted_page_query(model, field):
+    """ Returns a function building the first page of 'model' sorted by 'field'. """
+    table = model.__table__
+    return lambda: model.query.order_by(table.c[field], table.c.id).limit(50)
+
+# Every whitelisted sort has to read its page straight off an index (sorting by
+# id walks the table itself in order, so it needs none)
+for model in (User, Glass, Beer, Review):
+    for field in model.sort_fields[1:]:
+        hot_query('{}.sorted_by.{}'.format(model.__table__.name, field))\
+                (sorted_page_query(model, field))
+
+def top_query(ranking):
+    """ Returns a function building the leaderboard query for 'ranking'. """
+    return lambda: BeerScore.top_query(ranking, 50, 5)
+
+for ranking in BeerScore.rankings:
+    hot_query('beer_score.top.{}'.format(ranking))(top_query(ranking))
@@ -0,0 +1,109 @@
+import re
+from sqlalchemy import DDL, event, text, and_, or_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import column
+from sqlalchemy.types import Float
+
+from app import db
+from app.models import Beer
+from app.pagination import encode_cursor, decode_cursor
+
+# Beer columns covered by the full-text index, in index order
+search_columns = ('name', 'brewer', 'style', 'brew_location')
+
+# The index holds no copy of the text (content='beer'), triggers keep it in
+# step with every write to the beer table, bulk inserts included
+search_ddl = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS beer_fts USING fts5({columns},"
+        " content='beer', content_rowid='id', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS beer_fts_insert AFTER INSERT ON beer BEGIN"
+        " INSERT INTO beer_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER IF NOT EXISTS beer_fts_delete AFTER DELETE ON beer BEGIN"
+        " INSERT INTO beer_fts(beer_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER IF NOT EXISTS beer_fts_update AFTER UPDATE OF {columns} ON beer BEGIN"
+        " INSERT INTO beer_fts(beer_fts, rowid, {columns}) VALUES ('delete', old.id, {old});"
+        " INSERT INTO beer_fts(rowid, {columns}) VALUES (new.id, {new}); END"]
+search_ddl = [statement.format(columns=', '.join(search_columns),\
+        new=', '.join('new.' + c for c in search_columns),\
+        old=', '.join('old.' + c for c in search_columns)) for statement in search_ddl]
+
+def fts5_supported(ddl=None, target=None, bind=None, **kw):
+    """ Returns True if 'bind' (default: the primary engine) is SQLite built with FTS5. """
+    bind = bind or db.engine
+    if bind.dialect.name != 'sqlite':
+        return False
+    options = set(row[0] for row in bind.execute('PRAGMA compile_options'))
+    return 'ENABLE_FTS5' in options
+
+for statement in search_ddl:
+    event.listen(Beer.__table__, 'after_create', DDL(statement).execute_if(callable_=fts5_supported))
+event.listen(Beer.__table__, 'before_drop',\
+        DDL('DROP TABLE IF EXISTS beer_fts').execute_if(callable_=fts5_supported))
+
+def create_search_index(bind=None):
+    """ Creates the full-text index and its triggers if missing, returns True if it was built.
+
+    Used to upgrade databases created before the index existed, the index is
+    filled from the beers already stored.
+
+    """
+    bind = bind or db.engine
+    if not fts5_supported(bind=bind) or search_index_exists(bind):
+        return False
+    with bind.begin() as connection:
+        for statement in search_ddl:
+            connection.execute(statement)
+        connection.execute("INSERT INTO beer_fts(beer_fts) VALUES ('rebuild')")
+    return True
+
+def search_index_exists(bind=None):
+    """ Returns True if the database behind 'bind' (default: the session) has the full-text index. """
+    return (bind or db.session).execute("SELECT count(*) FROM sqlite_master"\
+            " WHERE type = 'table' AND name = 'beer_fts'").scalar() > 0
+
+def search_terms(query):
+    """ Splits a search string into its words, dropping punctuation and FTS operators. """
+    return re.findall(r'\w+', query or '', re.UNICODE)
+
+def match_expression(terms):
+    """ Returns the FTS5 MATCH expression requiring every term, each as a prefix. """
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+def search(terms, limit, after=None):
+    """ Returns a page of beers matching every term and the cursor of the next page (or None).
+
+    Results are ranked by bm25 (best first) with the beer id breaking ties,
+    pages continue after the (rank, id) of the previous page's last beer.
+
+    Keyword arguments:
+
+    |  **terms** -- the words to search for, from search_terms()
+    |  **limit** -- page size
+    |  **after** -- cursor of the previous page
+
+    """
+    clause = ''
+    params = {'match': match_expression(terms), 'limit': limit + 1}
+    if after is not None:
+        params['rank'], params['id'] = decode_cursor(after, column('rank', Float))
+        clause = 'WHERE rank > :rank OR (rank = :rank AND id > :id)'
+    rows = db.session.execute(text('SELECT id, rank FROM (SELECT rowid AS id,'\
+            ' bm25(beer_fts) AS rank FROM beer_fts WHERE beer_fts MATCH :match) ' + clause +\
+            ' ORDER BY rank, id LIMIT :limit'), params).fetchall()
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    beers = dict((b.id, b) for b in Beer.query.filter(Beer.id.in_([id for id, rank in rows])))\
+            if rows else {}
+    return [beers[id] for id, rank in rows if id in beers], cursor
+
+def like_search(terms):
+    """ Returns a query of beers containing every term in one of the searched columns.
+
+    Fallback for databases without the full-text index, it scans the table.
+
+    """
+    table = Beer.__table__
+    return Beer.query.filter(and_(*[or_(*[table.c[name].like('%' + term + '%')\
+            for name in search_columns]) for term in terms]))
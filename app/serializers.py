@@ -0,0 +1,117 @@
+from operator import attrgetter, itemgetter
+from flask import g, url_for, has_request_context
+
+from app.cache import cache_tag
+
+# Id placeholder used to turn a url_for() result into a link template
+LINK_PLACEHOLDER = 2147483629
+
+def link_template(endpoint):
+    """ Returns the (prefix, suffix) around the id in links to 'endpoint', resolved once per request. """
+    templates = {}
+    if has_request_context():
+        templates = getattr(g, 'link_templates', None)
+        if templates is None:
+            templates = g.link_templates = {}
+    if endpoint not in templates:
+        link = url_for(endpoint, id=LINK_PLACEHOLDER, _external=True)
+        prefix, suffix = link.split(str(LINK_PLACEHOLDER))
+        templates[endpoint] = (prefix, suffix)
+    return templates[endpoint]
+
+class Link(object):
+    """ Schema field holding the api link of the object whose id is in 'column'.
+
+    Optional links are left out of the output when the id is empty.
+
+    """
+
+    def __init__(self, endpoint, column='id', optional=False):
+        self.endpoint = endpoint
+        self.column = column
+        self.optional = optional
+
+class Computed(object):
+    """ Schema field computed from other columns.
+
+    Keyword arguments:
+
+    |  **function**  -- called with the values of 'columns'
+    |  **columns**   -- the columns the value is computed from
+    |  **attribute** -- model attribute already holding the value, read instead
+                       of calling 'function' when serializing model objects
+
+    """
+
+    def __init__(self, function, columns, attribute=None):
+        self.function = function
+        self.columns = columns
+        self.attribute = attribute
+
+class Schema(object):
+    """ Declarative description of a model's JSON representation, compiled into a serializer.
+
+    'fields' is a list of (name, spec) pairs where spec is a column name, a
+    Link or a Computed. Compiling turns every field into a getter once, so
+    serializing a list only calls getters, and every Link is resolved into
+    a template once per request instead of calling url_for() per object.
+
+    Records are model objects, or row tuples (e.g. from a Core select) when
+    serialize_all() is given the tuple's column names.
+
+    """
+
+    def __init__(self, tag, fields):
+        self.tag = tag + ':{}'
+        self.fields = fields
+        self.compiled = {}
+
+    def compile(self, columns=None):
+        """ Returns the id getter and (name, getter, link endpoint, optional) steps for records laid out as 'columns'. """
+        if columns in self.compiled:
+            return self.compiled[columns]
+        if columns is None:
+            getter = attrgetter
+        else:
+            position = dict((name, i) for i, name in enumerate(columns))
+            getter = lambda name: itemgetter(position[name])
+        steps = []
+        for name, spec in self.fields:
+            if isinstance(spec, Link):
+                steps.append((name, getter(spec.column), spec.endpoint, spec.optional))
+            elif isinstance(spec, Computed):
+                if columns is None and spec.attribute is not None:
+                    steps.append((name, attrgetter(spec.attribute), None, False))
+                    continue
+                values = [getter(column) for column in spec.columns]
+                function = spec.function
+                steps.append((name, lambda record, values=values, function=function:\
+                        function(*[value(record) for value in values]), None, False))
+            else:
+                steps.append((name, getter(spec), None, False))
+        self.compiled[columns] = steps = (getter('id'), steps)
+        return steps
+
+    def serialize(self, record):
+        """ Returns the JSON representation of one model object. """
+        return self.serialize_all([record])[0]
+
+    def serialize_all(self, records, columns=None):
+        """ Returns the JSON representations of 'records' (model objects, or row tuples laid out as 'columns'). """
+        key, steps = self.compile(tuple(columns) if columns is not None else None)
+        links = dict((endpoint, link_template(endpoint))\
+                for name, get, endpoint, optional in steps if endpoint)
+        results = []
+        for record in records:
+            cache_tag(self.tag.format(key(record)))
+            serial = {}
+            for name, get, endpoint, optional in steps:
+                value = get(record)
+                if endpoint:
+                    if optional and not value:
+                        continue
+                    prefix, suffix = links[endpoint]
+                    value = prefix + str(value) + suffix
+                serial[name] = value
+            results.append(serial)
+        return results
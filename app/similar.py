@@ -0,0 +1,155 @@
+import threading
+import numpy
+from sqlalchemy import select
+
+from app import app, db
+from app.models import Beer, TableVersion
+
+# Beer columns compared as numbers, each standardized to mean 0 and variance 1
+numeric_features = ('abv', 'ibu', 'calories')
+
+def to_float(value):
+    """ Returns 'value' as a float, NaN if it's missing or not a number. """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+def feature_row(beer):
+    """ Returns the (id, abv, ibu, calories, style, glass_type_id) tuple the index stores for a Beer. """
+    return (beer.id, beer.abv, beer.ibu, beer.calories, beer.style, beer.glass_type_id)
+
+def beer_version():
+    """ Returns the beer table's version, call it in the transaction that bumped it. """
+    return TableVersion.current(['beer'])['beer'][0]
+
+class SimilarityIndex(object):
+    """ Nearest-neighbour index over the beer catalog's attributes.
+
+    Each beer is a row of a feature matrix: abv, ibu and calories as
+    floats, style and glass type as integer codes. Distances from one beer
+    to all the others are computed in a single vectorized pass, the
+    numeric columns are standardized at query time so rows can be added,
+    changed and removed without renormalizing the matrix.
+
+    The index remembers the beer table version it reflects. Write routes
+    apply their own changes with upsert() and remove(), a read finding the
+    table at another version (changed by a different worker) reloads it.
+
+    """
+
+    def __init__(self):
+        self.version = None
+        self.size = 0
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.numeric = numpy.zeros((0, len(numeric_features)))
+        self.styles = numpy.zeros(0, dtype=numpy.int64)
+        self.glasses = numpy.zeros(0, dtype=numpy.int64)
+        self.positions = {}
+        self.style_codes = {}
+        self.lock = threading.Lock()
+
+    def load(self, version):
+        """ Rebuilds the whole matrix from the beer table. """
+        table = Beer.__table__
+        rows = db.session.execute(select([table.c.id] +\
+                [table.c[name] for name in numeric_features] +\
+                [table.c.style, table.c.glass_type_id])).fetchall()
+        self.size = 0
+        self.positions = {}
+        self.style_codes = {}
+        self.reserve(len(rows))
+        self.store(rows)
+        self.version = version
+
+    def reserve(self, count):
+        """ Makes room for 'count' more rows, growing the arrays geometrically. """
+        needed = self.size + count
+        if needed <= len(self.ids):
+            return
+        capacity = max(needed, 2 * len(self.ids), 64)
+        self.ids = numpy.resize(self.ids, capacity)
+        self.numeric = numpy.resize(self.numeric, (capacity, len(numeric_features)))
+        self.styles = numpy.resize(self.styles, capacity)
+        self.glasses = numpy.resize(self.glasses, capacity)
+
+    def store(self, rows):
+        """ Writes feature rows over existing beers or after the last row. """
+        for id, abv, ibu, calories, style, glass_type_id in rows:
+            position = self.positions.get(id)
+            if position is None:
+                position = self.positions[id] = self.size
+                self.size += 1
+            self.ids[position] = id
+            self.numeric[position] = [to_float(abv), to_float(ibu), to_float(calories)]
+            self.styles[position] = self.style_codes.setdefault(style, len(self.style_codes))
+            self.glasses[position] = glass_type_id or 0
+
+    def upsert(self, rows, version):
+        """ Adds or replaces the feature rows of beers written in the transaction that reached 'version'. """
+        with self.lock:
+            if self.version != version - 1:
+                self.version = None
+                return
+            self.reserve(len(rows))
+            self.store(rows)
+            self.version = version
+
+    def remove(self, ids, version):
+        """ Drops the rows of beers deleted in the transaction that reached 'version'. """
+        with self.lock:
+            if self.version != version - 1:
+                self.version = None
+                return
+            for id in ids:
+                position = self.positions.pop(id, None)
+                if position is None:
+                    continue
+                # Move the last row into the hole, positions stay dense
+                last = self.size - 1
+                if position != last:
+                    for array in (self.ids, self.numeric, self.styles, self.glasses):
+                        array[position] = array[last]
+                    self.positions[int(self.ids[position])] = position
+                self.size = last
+            self.version = version
+
+    def nearest(self, beer_id, k):
+        """ Returns up to 'k' (beer_id, distance) pairs closest to 'beer_id', nearest first.
+
+        The distance is Euclidean over the standardized numeric features
+        (a missing value counts as the column mean) plus a penalty for a
+        different style and for a different glass type.
+
+        """
+        version = beer_version()
+        with self.lock:
+            if self.version != version:
+                self.load(version)
+            position = self.positions.get(beer_id)
+            k = min(k, self.size - 1)
+            if position is None or k < 1:
+                return []
+            numeric = self.numeric[:self.size]
+            present = ~numpy.isnan(numeric)
+            counts = numpy.maximum(present.sum(axis=0), 1)
+            values = numpy.where(present, numeric, 0.0)
+            mean = values.sum(axis=0) / counts
+            deviation = numpy.where(present, numeric - mean, 0.0)
+            std = numpy.sqrt((deviation ** 2).sum(axis=0) / counts)
+            std[std == 0] = 1.0
+            scaled = deviation / std
+            distances = ((scaled - scaled[position]) ** 2).sum(axis=1)
+            distances += app.config['SIMILAR_STYLE_WEIGHT'] *\
+                    (self.styles[:self.size] != self.styles[position])
+            distances += app.config['SIMILAR_GLASS_WEIGHT'] *\
+                    (self.glasses[:self.size] != self.glasses[position])
+            distances = numpy.sqrt(distances)
+            distances[position] = numpy.inf
+            candidates = numpy.argpartition(distances, k - 1)[:k]
+            ids = self.ids[candidates]
+            order = numpy.lexsort((ids, distances[candidates]))
+            return list(zip(ids[order].tolist(), distances[candidates][order].tolist()))
+
+# This worker's index
+similar_index = SimilarityIndex()
@@ -0,0 +1,98 @@
+import threading
+import numpy
+from sqlalchemy import select
+
+from app import db
+from app.models import Beer, BeerScore, Review, TableVersion
+from app.similar import to_float
+
+# Tables the statistics are computed from
+stats_tables = ('beer', 'review')
+
+# Percentiles reported for each numeric beer attribute
+percentiles = (10, 25, 50, 75, 90)
+
+def rounded(value):
+    """ Returns a numpy scalar as a float rounded for display, None for NaN. """
+    value = float(value)
+    return None if numpy.isnan(value) else round(value, 3)
+
+def distribution(values, bins):
+    """ Returns the count, mean, percentiles and histogram of an array, ignoring NaNs. """
+    values = values[~numpy.isnan(values)]
+    if not len(values):
+        return {'count': 0, 'mean': None, 'percentiles': {}, 'histogram': []}
+    counts, edges = numpy.histogram(values, bins=bins)
+    points = numpy.percentile(values, percentiles)
+    return {'count': len(values), 'mean': rounded(values.mean()),\
+            'percentiles': dict((str(p), rounded(v)) for p, v in zip(percentiles, points)),\
+            'histogram': [{'low': rounded(low), 'high': rounded(high), 'count': int(count)}\
+            for low, high, count in zip(edges[:-1], edges[1:], counts)]}
+
+def group_means(groups, values, size):
+    """ Returns the mean of 'values' for each group code in 'groups', NaNs left out. """
+    present = ~numpy.isnan(values)
+    totals = numpy.bincount(groups[present], weights=values[present], minlength=size)
+    counts = numpy.bincount(groups[present], minlength=size)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return totals / counts
+
+def beer_stats(bins):
+    """ Returns the abv/ibu/calories distributions and per-style averages of the catalog. """
+    table, scores = Beer.__table__, BeerScore.__table__
+    rows = db.session.execute(select([table.c.abv, table.c.ibu, table.c.calories,\
+            table.c.style, scores.c.overall_average, scores.c.review_count])\
+            .select_from(table.outerjoin(scores, scores.c.beer_id == table.c.id))).fetchall()
+    numeric = numpy.array([[to_float(value) for value in row[:3]] for row in rows],\
+            dtype=float).reshape(len(rows), 3)
+    overall = numpy.array([row[4] if row[5] else numpy.nan for row in rows], dtype=float)
+    styles, groups = numpy.unique(numpy.array([row[3] or '' for row in rows], dtype=object),\
+            return_inverse=True)
+    counts = numpy.bincount(groups, minlength=len(styles))
+    means = [group_means(groups, values, len(styles))\
+            for values in (numeric[:, 0], numeric[:, 1], numeric[:, 2], overall)]
+    return {'count': len(rows),\
+            'abv': distribution(numeric[:, 0], bins),\
+            'ibu': distribution(numeric[:, 1], bins),\
+            'calories': distribution(numeric[:, 2], bins),\
+            'styles': [{'style': style or None, 'beers': int(count),\
+            'abv': rounded(means[0][i]), 'ibu': rounded(means[1][i]),\
+            'calories': rounded(means[2][i]), 'overall': rounded(means[3][i])}\
+            for i, (style, count) in enumerate(zip(styles, counts))]}
+
+def review_stats():
+    """ Returns how often each score was given, per category and overall. """
+    table = Review.__table__
+    categories = list(Review.score_max)
+    rows = db.session.execute(select([table.c[category] for category in categories]))\
+            .fetchall()
+    scores = numpy.array(rows, dtype=numpy.int64).reshape(len(rows), len(categories))
+    highest = sum(Review.score_max.values())
+    result = {'count': len(rows), 'categories': {}}
+    for i, category in enumerate(categories):
+        column = numpy.clip(scores[:, i], 0, Review.score_max[category])
+        result['categories'][category] = {\
+                'mean': rounded(column.mean()) if len(rows) else None,\
+                'scores': numpy.bincount(column, minlength=Review.score_max[category] + 1)\
+                .tolist()}
+    overall = numpy.clip(scores.sum(axis=1), 0, highest)
+    result['overall'] = {'mean': rounded(overall.mean()) if len(rows) else None,\
+            'scores': numpy.bincount(overall, minlength=highest + 1).tolist()}
+    return result
+
+# Latest statistics computed by this worker, keyed by table versions and bin count
+computed = {}
+computed_lock = threading.Lock()
+
+def catalog_stats(bins):
+    """ Returns the catalog statistics, recomputed only when the beer or review table changed. """
+    versions = TableVersion.current(stats_tables)
+    key = (tuple(sorted((name, version) for name, (version, modified) in versions.items())),\
+            bins)
+    with computed_lock:
+        if key not in computed:
+            # Statistics for older table versions will never be asked for again
+            for stale in [k for k in computed if k[0] != key[0]]:
+                del computed[stale]
+            computed[key] = {'beers': beer_stats(bins), 'reviews': review_stats()}
+        return computed[key]
@@ -0,0 +1,51 @@
+from itertools import islice
+from flask import Response, g, request, json, stream_with_context
+
+from app import app
+from app.loader import get_loader
+from app.pagination import ordered
+
+def wants_stream():
+    """ Returns True if the client asked for a streamed response with 'stream=true'. """
+    return (request.args.get('stream') or '').lower() in ('1', 'true', 'yes')
+
+def stream_results(query, model, serialize_all=None):
+    """ Returns a chunked response streaming {"results": [...]} for every row of 'query'.
+
+    Rows are pulled from the database STREAM_CHUNK_SIZE at a time and
+    encoded one by one, so memory use doesn't grow with the table: streamed
+    responses are never cached, so no cache tags are collected, and batch
+    loaded relationships are dropped after each chunk. The filter, 'sort_by'
+    and 'after' query arguments apply as for paginated listings.
+
+    Keyword arguments:
+
+    |  **query**         -- the query to stream
+    |  **model**         -- the db.Model class being listed
+    |  **serialize_all** -- function serializing a list of rows into a list of dicts
+                           (default: the model's schema)
+
+    """
+    if serialize_all is None:
+        serialize_all = model.schema.serialize_all
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    rows = iter(ordered(query, model).yield_per(chunk_size))
+    if 'cache_tags' in g:
+        del g.cache_tags
+
+    def generate():
+        separator = ''
+        yield '{"results": ['
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            encoded = []
+            for item in serialize_all(chunk):
+                encoded.append(separator + json.dumps(item))
+                separator = ', '
+            get_loader().clear()
+            yield ''.join(encoded)
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -6,3 +6,83 @@ SECRET_KEY = 'FreeBeer'
 # Database settings
 basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+
+# Engine profile: 'development' keeps SQLite's defaults and a fresh connection
+# per request, 'production' pools connections and applies SQLITE_PRAGMAS to each
+DATABASE_PROFILE = 'development'
+SQLITE_PRAGMAS = [
+        ('busy_timeout', 5000),             # wait up to 5s for a lock instead of failing
+        ('journal_mode', 'WAL'),            # readers don't block the writer (and vice versa)
+        ('synchronous', 'NORMAL'),          # safe with WAL, fsync only at checkpoints
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -64000),             # in KiB when negative
+        ('temp_store', 'MEMORY')]
+SQLITE_POOL_SIZE = 8
+SQLITE_POOL_OVERFLOW = 8
+SQLITE_POOL_TIMEOUT = 30
+
+# Read/write routing: GET requests read from this replica (None: from separate
+# query_only connections to the primary), a client that just wrote keeps
+# reading from the primary until the replica has its write, for at most
+# READ_STICKY_SECONDS, tracked by a cookie/header named READ_STICKY_COOKIE
+SQLALCHEMY_READ_DATABASE_URI = None
+READ_STICKY_SECONDS = 10
+READ_STICKY_COOKIE = 'X-Last-Write'
+
+# Pagination settings
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Authentication settings
+CREDENTIAL_CACHE_SIZE = 1024
+CREDENTIAL_CACHE_TTL = 300
+IDENTITY_CACHE_SIZE = 4096
+# Also how long a token revoked through another worker keeps working on this one
+IDENTITY_CACHE_TTL = 15
+
+# Seconds between batched writes of users' last_activity timestamps
+ACTIVITY_FLUSH_INTERVAL = 30
+
+# Response cache settings
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_LOG_RETENTION = 3600
+
+# Rows fetched per round trip when streaming list responses
+STREAM_CHUNK_SIZE = 500
+
+# Most items accepted by a single bulk request (keep below SQLite's 999 bound variables)
+BULK_MAX_ITEMS = 500
+
+# Records validated and committed together by the NDJSON review import
+IMPORT_CHUNK_SIZE = 500
+
+# Leaderboard settings, beers need TOP_MIN_REVIEWS reviews to be ranked
+TOP_DEFAULT_SIZE = 10
+TOP_MIN_REVIEWS = 5
+
+# Recommendation settings, the item-item model is built by ./run.py --buildrecommendations,
+# ./run.py --refreshrecommendations also folds in new reviews every RECOMMEND_REFRESH_INTERVAL
+# seconds, RECOMMEND_SYNC_BATCH at a time. Workers reload the model when the file changes
+RECOMMEND_MODEL_PATH = os.path.join(basedir, 'recommendations.pickle')
+RECOMMEND_NEIGHBORS = 50
+RECOMMEND_MAX_HISTORY = 200
+RECOMMEND_SYNC_BATCH = 1000
+RECOMMEND_REFRESH_INTERVAL = 60
+RECOMMEND_DEFAULT_SIZE = 10
+
+# Similar beers settings, distance added for a different style or glass type
+# (abv, ibu and calories differences are measured in standard deviations)
+SIMILAR_DEFAULT_SIZE = 10
+SIMILAR_STYLE_WEIGHT = 1.0
+SIMILAR_GLASS_WEIGHT = 0.5
+
+# Statistics settings, histogram bins per numeric beer attribute
+STATS_HISTOGRAM_BINS = 10
+STATS_MAX_BINS = 100
+
+# Beer catalog read model, beer listings are served from memory when enabled and
+# each worker starts from the snapshot, rewritten every READ_MODEL_SNAPSHOT_INTERVAL
+# seconds by a worker whose model changed
+READ_MODEL_ENABLED = False
+READ_MODEL_SNAPSHOT_PATH = os.path.join(basedir, 'catalog.snapshot')
+READ_MODEL_SNAPSHOT_INTERVAL = 300
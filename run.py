@@ -1,9 +1,21 @@
 #!venv/bin/python
 import argparse
+import sys
 from app import app
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--builddb", help="build the database", action="store_true")
+parser.add_argument("--upgradedb", help="add new tables, columns and indexes to an existing database, then check query plans",\
+        action="store_true")
+parser.add_argument("--rebuildscores", help="rebuild per-beer review score totals",\
+        action="store_true")
+parser.add_argument("--importreviews", metavar="FILE",\
+        help="import reviews from an NDJSON file (one review per line, with author)")
+parser.add_argument("--buildrecommendations", help="build the beer recommendation model",\
+        action="store_true")
+parser.add_argument("--refreshrecommendations",\
+        help="build the recommendation model, then keep folding new reviews into it",\
+        action="store_true")
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -12,6 +24,47 @@ if __name__ == '__main__':
         db.create_all()
         db.session.commit()
         print("Database created.")
+    elif args.upgradedb:
+        from app.schema import upgrade, check_plans
+        created = upgrade()
+        print("Database upgraded, {} column(s)/index(es) added.".format(len(created)))
+        for name in created:
+            print("  {}".format(name))
+        scans = check_plans()
+        if scans:
+            for name, plan in scans.items():
+                print("ERROR: hot query '{}' scans a table: {}".format(name, '; '.join(plan)))
+            sys.exit(1)
+        print("Query plans checked, every hot query uses an index.")
+    elif args.rebuildscores:
+        from app import db
+        from app.models import BeerScore
+        db.create_all()
+        changed = BeerScore.rebuild()
+        db.session.commit()
+        print("Score totals rebuilt, {} beer(s) were out of sync.".format(len(changed)))
+        for beer_id in changed:
+            print("  beer #{}".format(beer_id))
+    elif args.importreviews:
+        from app import db
+        from app.importer import import_reviews
+        db.create_all()
+        with open(args.importreviews, 'rb') as lines:
+            imported, errors = import_reviews(lines)
+        print("{} review(s) imported, {} rejected.".format(imported, len(errors)))
+        for error in errors:
+            print("  line {}: {}".format(error['line'], error['error']))
+    elif args.buildrecommendations:
+        from app.recommend import CooccurrenceMatrix
+        matrix = CooccurrenceMatrix.build(app.config['RECOMMEND_MAX_HISTORY'])
+        model = matrix.model(app.config['RECOMMEND_NEIGHBORS'])
+        model.save(app.config['RECOMMEND_MODEL_PATH'])
+        print("Recommendation model built for {} beer(s).".format(len(model.beer_ids)))
+    elif args.refreshrecommendations:
+        from app.recommend import keep_refreshed
+        print("Keeping the recommendation model current, every {} second(s)..."\
+                .format(app.config['RECOMMEND_REFRESH_INTERVAL']))
+        keep_refreshed(app.config['RECOMMEND_MODEL_PATH'], app.config['RECOMMEND_REFRESH_INTERVAL'])
     else:
         app.run(host='0.0.0.0', debug=True)
         print("Starting development server...")
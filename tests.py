@@ -1,12 +1,29 @@
 import os
+import shutil
 import unittest
+import flask
 from flask import json
+from sqlalchemy import event, create_engine, select
+from sqlalchemy.exc import OperationalError
 from passlib.apps import custom_app_context as pwd_context
-from base64 import b64encode
+from base64 import b64encode, urlsafe_b64encode
+from datetime import datetime
 
 from config import basedir
 from app import app, db
-from app.models import User, Glass, Beer, Review
+from app.models import User, Glass, Beer, BeerScore, Review, TableVersion,\
+        CacheInvalidation, favorite, identity_cache
+from app.activity import activity
+from app.loader import get_loader
+from app.streaming import stream_results
+from app.importer import recent_reviews
+from app.engine import sqlite_pragmas
+from app.schema import missing_indexes, upgrade, check_plans
+from app.response_cache import response_cache
+from app import recommend
+from app.similar import similar_index, beer_version
+from app.stats import computed
+from app.read_model import CatalogReadModel, catalog
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -14,11 +31,15 @@ class TestCase(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///'+os.path.join(basedir, 'testing.db')
         self.app = app.test_client()
         db.create_all()
+        response_cache.reset()
+        similar_index.version = None
+        catalog.version = None
         u = User('testunit1', 'unit1@tests.local', 'testing')
         db.session.add(u)
         db.session.commit()
 
     def tearDown(self):
+        activity.flush()
         db.session.remove()
         db.drop_all()
 
@@ -122,6 +143,699 @@ class TestCase(unittest.TestCase):
         u = User.query.get(1)
         assert u.favorites == []
 
+    # Review routes keep the beer's score totals in sync
+    def test_review_score_totals(self):
+        b = Beer('Fat Tire', 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA')
+        db.session.add(b)
+        db.session.commit()
+        data = json.dumps({'aroma':4, 'appearance':2, 'taste':8, 'palate':4, \
+                'bottle_style':4, 'beer_id':'1'})
+        rv = self.open_with_auth('/beer/api/v0.1/reviews', 'POST', data)
+        assert rv.status_code == 201
+        assert Beer.query.get(1).average_scores['taste'] == 8
+        rv = self.open_with_auth('/beer/api/v0.1/reviews/1', 'PUT',\
+                json.dumps({'taste':6}))
+        assert rv.status_code == 200
+        assert Beer.query.get(1).average_scores['taste'] == 6
+        assert BeerScore.rebuild() == []
+        rv = self.open_with_auth('/beer/api/v0.1/reviews/1', 'DELETE', json.dumps({}))
+        assert rv.status_code == 200
+        s = BeerScore.query.get(1)
+        assert s.review_count == 0 and s.taste == 0
+
+    # Page through beers sorted by abv using the 'next' cursor links
+    def test_keyset_pagination(self):
+        for i, abv in enumerate(['4.60', '5.20', '4.60', None]):
+            db.session.add(Beer('Beer '+str(i), 'New Belgium', '4', '20', abv, 'Ale', 'USA'))
+        db.session.commit()
+        url = '/beer/api/v0.1/beers?sort_by=abv%20desc&limit=1'
+        names = []
+        while url:
+            rv = self.app.get(url)
+            assert rv.status_code == 200
+            data = json.loads(rv.data)
+            names += [b['name'] for b in data['results']]
+            url = data['next'] and data['next'].replace('http://localhost', '')
+        assert names == ['Beer 1', 'Beer 2', 'Beer 0', 'Beer 3']
+        rv = self.app.get('/beer/api/v0.1/beers?sort_by=password')
+        assert rv.status_code == 400
+        # Crafted cursors holding other JSON than a (value, id) pair are rejected
+        for cursor in ([[1], 2], {'a': 1, 'b': 2}, [4.6, [1]], [4.6, '2'], [4.6, 2, 3],\
+                [4.6, 2 ** 70]):
+            after = urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+            rv = self.app.get('/beer/api/v0.1/beers?sort_by=abv&after=' + after)
+            assert rv.status_code == 400, cursor
+
+    # Listing glasses runs a fixed number of queries however many beers they hold
+    def test_glass_listing_query_count(self):
+        def count_queries():
+            response_cache.clear()
+            queries = []
+            listener = lambda *args: queries.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            rv = self.app.get('/beer/api/v0.1/glasses')
+            event.remove(db.engine, 'before_cursor_execute', listener)
+            assert rv.status_code == 200
+            return len(queries)
+        def add_glass(name):
+            g = Glass(name)
+            db.session.add(g)
+            db.session.commit()
+            for i in range(3):
+                b = Beer(name+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA')
+                b.glass_type_id = g.id
+                db.session.add(b)
+            db.session.commit()
+        add_glass('Goblet')
+        first = count_queries()
+        add_glass('Tulip')
+        add_glass('Snifter')
+        assert count_queries() == first
+        rv = self.app.get('/beer/api/v0.1/glasses')
+        assert len(json.loads(rv.data)['results'][2]['beers']) == 3
+
+    # The favorites of every listed user are batch-loaded in one query
+    def test_all_favorites_listing(self):
+        beers = [Beer('Beer'+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA')\
+                for i in range(3)]
+        u1 = User.query.get(1)
+        u2 = User('testunit2', 'unit2@tests.local', 'testing2')
+        db.session.add_all(beers + [u2])
+        for user, favorites in ((u1, beers[:2]), (u2, beers[1:])):
+            for beer in favorites:
+                user.add_to_favorites(beer)
+        db.session.commit()
+        rv = self.open_with_auth('/beer/api/v0.1/favorites', 'GET')
+        assert rv.status_code == 200
+        lists = {}
+        for entry in json.loads(rv.data)['results']:
+            lists.update(entry)
+        assert sorted(b['name'] for b in lists['testunit1']) == ['Beer0', 'Beer1']
+        assert sorted(b['name'] for b in lists['testunit2']) == ['Beer1', 'Beer2']
+
+    # Changing a password drops the cached credentials
+    def test_password_change_invalidates_credentials(self):
+        rv = self.open_with_auth('/beer/api/v0.1/token', 'GET')
+        assert rv.status_code == 200
+        rv = self.open_with_auth('/beer/api/v0.1/users/1', 'PUT',\
+                json.dumps({'password': 'testing2'}))
+        assert rv.status_code == 200
+        assert pwd_context.verify('testing2', User.query.get(1).password)
+        rv = self.open_with_auth('/beer/api/v0.1/token', 'GET')
+        assert rv.status_code == 403
+
+    # Authenticate with a token, which stops working after a password change
+    def test_token_authentication(self):
+        rv = self.open_with_auth('/beer/api/v0.1/token', 'GET')
+        token = json.loads(rv.data)['token']
+        header = {'Authorization': 'Basic ' +\
+                b64encode((token + ':').encode('ascii')).decode('ascii')}
+        for i in range(2):
+            rv = self.app.get('/beer/api/v0.1/token', headers=header)
+            assert rv.status_code == 200
+        rv = self.open_with_auth('/beer/api/v0.1/users/1', 'PUT',\
+                json.dumps({'password': 'testing2'}))
+        assert rv.status_code == 200
+        rv = self.app.get('/beer/api/v0.1/token', headers=header)
+        assert rv.status_code == 403
+
+    # Cached token identities skip the database, and expire after changes made elsewhere
+    def test_token_revoked_elsewhere(self):
+        rv = self.open_with_auth('/beer/api/v0.1/token', 'GET')
+        token = json.loads(rv.data)['token']
+        header = {'Authorization': 'Basic ' +\
+                b64encode((token + ':').encode('ascii')).decode('ascii')}
+        rv = self.app.get('/beer/api/v0.1/token', headers=header)
+        assert rv.status_code == 200
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        assert User.check_auth_token(token).id == 1
+        event.remove(db.engine, 'before_cursor_execute', listener)
+        assert queries == []
+        # Deleted behind this worker's back, the cached identity can't find its row
+        db.session.execute(User.__table__.delete().where(User.__table__.c.id == 1))
+        db.session.commit()
+        rv = self.app.get('/beer/api/v0.1/token', headers=header)
+        assert rv.status_code == 401
+        # Once the identity expires the token goes back to the database
+        identity_cache.clear()
+        rv = self.app.get('/beer/api/v0.1/token', headers=header)
+        assert rv.status_code == 403
+
+    # last_activity is buffered and written by a background flush, invalidating nothing
+    def test_activity_write_behind(self):
+        before = User.query.get(1).last_activity
+        rv = self.open_with_auth('/beer/api/v0.1/token', 'GET')
+        assert rv.status_code == 200
+        assert 1 in activity.pending and activity.thread.is_alive()
+        version = TableVersion.current(['user'])['user']
+        logged = CacheInvalidation.query.count()
+        assert activity.flush() == 1
+        db.session.expire_all()
+        assert User.query.get(1).last_activity > before
+        assert TableVersion.current(['user'])['user'] == version
+        assert CacheInvalidation.query.count() == logged
+
+    # Conditional GETs get a 304 until the beer table changes
+    def test_conditional_get(self):
+        rv = self.app.get('/beer/api/v0.1/beers')
+        etag = rv.headers['ETag']
+        rv = self.app.get('/beer/api/v0.1/beers', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        data = json.dumps({u'name':'Spotted Cow', u'brewer':'New Glarus',\
+                u'abv':'4.80', u'style':'Cream Ale'})
+        rv = self.open_with_auth('/beer/api/v0.1/beers', 'POST', data)
+        assert rv.status_code == 201
+        assert CacheInvalidation.query.filter_by(tag='glass:None').count() == 0
+        rv = self.app.get('/beer/api/v0.1/beers', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        rv = self.app.get('/beer/api/v0.1/beers',\
+                headers={'If-Modified-Since': rv.headers['Last-Modified']})
+        assert rv.status_code == 304
+
+    # Cached beer responses are dropped when a review of that beer is posted
+    def test_response_cache_invalidation(self):
+        for name in ['Fat Tire', 'Skinny Tire']:
+            db.session.add(Beer(name, 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA'))
+        db.session.commit()
+        self.app.get('/beer/api/v0.1/beers/1')
+        self.app.get('/beer/api/v0.1/beers/2')
+        hits = response_cache.hits
+        rv = self.app.get('/beer/api/v0.1/beers/1')
+        assert response_cache.hits == hits + 1
+        data = json.dumps({'aroma':4, 'appearance':4, 'taste':4, 'palate':4, \
+                'bottle_style':4, 'beer_id':'1'})
+        rv = self.open_with_auth('/beer/api/v0.1/reviews', 'POST', data)
+        assert rv.status_code == 201
+        rv = self.app.get('/beer/api/v0.1/beers/1')
+        assert json.loads(rv.data)['results']['average_scores']['taste'] == 4
+        self.app.get('/beer/api/v0.1/beers/2')
+        assert response_cache.hits == hits + 2
+        rv = self.open_with_auth('/beer/api/v0.1/cache', 'GET')
+        assert json.loads(rv.data)['results']['hits'] == hits + 2
+
+    # Stream the full beer list in one chunked response
+    def test_streamed_listing(self):
+        for i in range(5):
+            db.session.add(Beer('Beer '+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        db.session.commit()
+        app.config['STREAM_CHUNK_SIZE'] = 2
+        rv = self.app.get('/beer/api/v0.1/beers?stream=true&sort_by=name%20desc')
+        app.config['STREAM_CHUNK_SIZE'] = 500
+        assert rv.status_code == 200
+        names = [b['name'] for b in json.loads(rv.data)['results']]
+        assert names == ['Beer 4', 'Beer 3', 'Beer 2', 'Beer 1', 'Beer 0']
+        # Nothing kept per request grows with the number of rows streamed
+        for i in range(3):
+            glass = Glass('Glass '+str(i))
+            glass.beers.append(Beer.query.get(i + 1))
+            db.session.add(glass)
+        db.session.commit()
+        with app.test_request_context('/beer/api/v0.1/glasses?stream=true'):
+            flask.g.cache_tags = set()
+            app.config['STREAM_CHUNK_SIZE'] = 1
+            response = stream_results(Glass.query, Glass, Glass.serialize_all)
+            held = [sum(len(v) for v in get_loader().loaded.values())\
+                    for part in response.response]
+            app.config['STREAM_CHUNK_SIZE'] = 500
+            assert len(held) == 5 and max(held) == 0 and 'cache_tags' not in flask.g
+
+    # Create several beers at once, with per-item errors
+    def test_bulk_beer_creation(self):
+        db.session.add(Glass('Goblet'))
+        db.session.add(Beer('Fat Tire', 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA'))
+        db.session.commit()
+        data = json.dumps({'beers': [
+            {'name': 'Spotted Cow', 'style': 'Cream Ale', 'abv': 4.8, 'glass_type': 1},
+            {'name': 'Fat Tire', 'style': 'Amber Ale', 'abv': 4.6},
+            {'name': 'Moon Man', 'style': 'Pale Ale', 'abv': 5.0, 'glass_type': 9},
+            {'name': 'Spotted Cow', 'style': 'Cream Ale', 'abv': 4.8},
+            {'name': 'Two Women', 'style': 'Lager', 'abv': 5.2}]})
+        rv = self.open_with_auth('/beer/api/v0.1/beers/batch', 'POST', data)
+        assert rv.status_code == 201
+        statuses = [r['status'] for r in json.loads(rv.data)['results']]
+        assert statuses == ['created', 'error', 'error', 'error', 'created']
+        b = Beer.query.filter_by(name='Spotted Cow').first()
+        assert b.glass_type_id == 1 and b.scores.review_count == 0
+        rv = self.open_with_auth('/beer/api/v0.1/beers/batch', 'POST', data)
+        assert rv.status_code == 400
+
+    # Import reviews from NDJSON, rejecting bad lines into the report
+    def test_review_import(self):
+        db.session.add(Beer('Fat Tire', 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA'))
+        db.session.commit()
+        scores = {'aroma': 3, 'appearance': 3, 'taste': 8, 'palate': 4, 'bottle_style': 1}
+        lines = [dict(scores, beer_id=1, created_on='2014-03-01T18:30:00'),
+                dict(scores, beer_id=1, created_on='2014-03-03T18:30:00'),
+                dict(scores, beer_id=1),
+                dict(scores, beer_id=2),
+                dict(scores, beer_id=1, taste=11)]
+        data = '\n'.join(json.dumps(line) for line in lines) + '\n{not json\n'
+        rv = self.app.open('/beer/api/v0.1/reviews/import', method='POST', headers={
+            'Authorization': 'Basic ' + b64encode('testunit1' + ":" + 'testing'),
+            'Content-Type': 'application/x-ndjson'}, data=data)
+        assert rv.status_code == 201
+        report = json.loads(rv.data)
+        assert report['imported'] == 2
+        assert [e['line'] for e in report['errors']] == [2, 4, 5, 6]
+        b = Beer.query.get(1)
+        assert b.scores.review_count == 2 and b.scores.taste == 16
+        # More pairs than SQLite takes bound variables are looked up in batches
+        pairs = set([(1, 1)] + [(i, i) for i in range(2, 1200)])
+        variables = []
+        listener = lambda *args: variables.append(len(args[3]))
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        reviewed = recent_reviews(pairs, datetime(2014, 3, 1), datetime(2014, 3, 1))
+        event.remove(db.engine, 'before_cursor_execute', listener)
+        assert list(reviewed) == [(1, 1)] and len(reviewed[(1, 1)]) == 1
+        assert len(variables) > 1 and max(variables) < 999
+
+    # A favorites list costs the same number of queries however long it is
+    def test_favorites_creation_query_count(self):
+        for i in range(40):
+            db.session.add(Beer('Beer'+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        db.session.commit()
+        def count_queries(user_id, beers):
+            activity.flush()
+            queries = []
+            listener = lambda *args: queries.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            rv = self.open_with_auth('/beer/api/v0.1/users/{}/favorites'.format(user_id),\
+                    'POST', json.dumps({'beers': beers}))
+            event.remove(db.engine, 'before_cursor_execute', listener)
+            assert rv.status_code == 201
+            return len(queries)
+        db.session.add(User('testunit2', 'unit2@tests.local', 'testing2'))
+        db.session.add(User('testunit3', 'unit3@tests.local', 'testing3'))
+        db.session.commit()
+        count_queries(1, [1])
+        first = count_queries(2, [1, '2'])
+        assert count_queries(3, list(range(1, 41))) == first
+        assert len(User.query.get(3).favorites) == 40
+        rv = self.open_with_auth('/beer/api/v0.1/users/1/favorites', 'POST',\
+                json.dumps({'beers': [3, 99]}))
+        assert rv.status_code == 400
+
+    # The favorites overview pages over users
+    def test_all_favorites_paging(self):
+        for i in range(3):
+            db.session.add(Beer('Beer'+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        db.session.add(User('testunit2', 'unit2@tests.local', 'testing2'))
+        db.session.commit()
+        for user_id, beers in ((1, [1, 2]), (2, [2, 3])):
+            rv = self.open_with_auth('/beer/api/v0.1/users/{}/favorites'.format(user_id),\
+                    'POST', json.dumps({'beers': beers}))
+            assert rv.status_code == 201
+        rv = self.open_with_auth('/beer/api/v0.1/favorites?limit=1', 'GET')
+        page = json.loads(rv.data)
+        assert [len(b) for b in page['results'][0].values()] == [2]
+        rv = self.open_with_auth(page['next'].replace('http://localhost', ''), 'GET')
+        page = json.loads(rv.data)
+        assert page['next'] is None
+        assert sorted(b['name'] for b in page['results'][0]['testunit2']) == ['Beer1', 'Beer2']
+
+    # Upgrading an existing database adds the missing indexes
+    def test_schema_upgrade(self):
+        db.engine.execute('DROP INDEX ix_review_author_beer_created_on')
+        assert [i.name for i in missing_indexes()] == ['ix_review_author_beer_created_on']
+        assert upgrade() == ['ix_review_author_beer_created_on']
+        assert missing_indexes() == [] and upgrade() == []
+        db.session.add(Beer('Fat Tire', 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA'))
+        db.session.commit()
+        data = json.dumps({'beer_id': 1, 'aroma': 3, 'appearance': 3, 'taste': 8,\
+                'palate': 4, 'bottle_style': 1})
+        rv = self.open_with_auth('/beer/api/v0.1/reviews', 'POST', data)
+        assert rv.status_code == 201
+        rv = self.open_with_auth('/beer/api/v0.1/reviews', 'POST', data)
+        assert rv.status_code == 400
+
+    # Every hot query is answered from an index
+    def test_hot_query_plans(self):
+        assert check_plans() == {}
+        db.engine.execute('DROP INDEX ix_review_beer_id')
+        assert list(check_plans()) == ['beer.reviews']
+        upgrade()
+        assert check_plans() == {}
+
+    # The production profile's pragmas are applied to new connections
+    def test_sqlite_pragmas(self):
+        path = os.path.join(basedir, 'pragmas.db')
+        engine = create_engine('sqlite:///' + path + '?check_same_thread=false')
+        event.listen(engine, 'connect', sqlite_pragmas(app.config['SQLITE_PRAGMAS']))
+        try:
+            assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert engine.execute('PRAGMA synchronous').scalar() == 1
+            assert engine.execute('PRAGMA busy_timeout').scalar() == 5000
+        finally:
+            engine.dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    # GET requests read from the read engine unless the client wrote something it
+    # lacks, the response cache's invalidation log is always read from the primary
+    def test_read_write_routing(self):
+        replica = os.path.join(basedir, 'testing_replica.db')
+        def replicate():
+            db.get_read_engine().dispose()
+            shutil.copyfile(os.path.join(basedir, 'testing.db'), replica)
+        def engines_used(request):
+            used = set()
+            engines = (('primary', db.engine), ('read', db.get_read_engine()))
+            ignored = ('cache_invalidation', 'max(table_version.modified)')
+            listeners = [(engine, lambda *args, name=name: any(i in args[2] for i in ignored)\
+                    or used.add(name)) for name, engine in engines]
+            for engine, listener in listeners:
+                event.listen(engine, 'before_cursor_execute', listener)
+            rv = request()
+            for engine, listener in listeners:
+                event.remove(engine, 'before_cursor_execute', listener)
+            assert rv.status_code < 400
+            return used
+        anonymous = lambda: self.app.get('/beer/api/v0.1/glasses')
+        replicate()
+        app.config['SQLALCHEMY_READ_DATABASE_URI'] = 'sqlite:///' + replica
+        try:
+            assert engines_used(anonymous) == set(['read'])
+            assert engines_used(lambda: self.open_with_auth('/beer/api/v0.1/glasses', 'POST',\
+                    json.dumps({'name': 'Goblet'}))) == set(['primary'])
+            # The write's cookie follows the client to any worker until the replica has it
+            assert engines_used(lambda: self.open_with_auth('/beer/api/v0.1/glasses', 'GET'))\
+                    == set(['primary'])
+            # Clients that haven't written read from the replica meanwhile
+            assert engines_used(lambda: app.test_client().get('/beer/api/v0.1/glasses'))\
+                    == set(['read'])
+            replicate()
+            assert engines_used(anonymous) == set(['read'])
+            self.assertRaises(OperationalError, db.get_read_engine().execute,\
+                    "INSERT INTO glass (name) VALUES ('Tulip')")
+        finally:
+            app.config['SQLALCHEMY_READ_DATABASE_URI'] = None
+            db.get_read_engine()
+            os.remove(replica)
+
+    # Search beers through the full-text index, ranked and paged
+    def test_beer_search(self):
+        rows = [('Fat Tire', 'New Belgium', 'Amber Ale'), ('Ranger', 'New Belgium', 'IPA'),\
+                ('Amber Waves', 'Amber Brewing', 'Amber Ale'), ('Spotted Cow', 'New Glarus', 'Ale')]
+        for name, brewer, style in rows:
+            db.session.add(Beer(name, brewer, '4', '20', '4.60', style, 'USA'))
+        db.session.commit()
+        rv = self.app.get('/beer/api/v0.1/beers/search?q=amber&limit=1')
+        page = json.loads(rv.data)
+        assert page['results'][0]['name'] == 'Amber Waves'
+        rv = self.app.get(page['next'].replace('http://localhost', ''))
+        page = json.loads(rv.data)
+        assert [b['name'] for b in page['results']] == ['Fat Tire'] and page['next'] is None
+        b = Beer.query.filter_by(name='Ranger').first()
+        b.style = 'Amber IPA'
+        db.session.delete(Beer.query.filter_by(name='Fat Tire').first())
+        db.session.commit()
+        rv = self.app.get('/beer/api/v0.1/beers/search?q=new%20belg%20amb')
+        assert [b['name'] for b in json.loads(rv.data)['results']] == ['Ranger']
+        db.engine.execute('DROP TABLE beer_fts')
+        response_cache.clear()
+        rv = self.app.get('/beer/api/v0.1/beers/search?q=new%20belg%20amb')
+        assert [b['name'] for b in json.loads(rv.data)['results']] == ['Ranger']
+        assert self.app.get('/beer/api/v0.1/beers/search?q=%22').status_code == 400
+
+    # Filter and sort listings with the whitelisted arguments
+    def test_listing_filters(self):
+        rows = [('Fat Tire', 'Amber Ale', 20, 5.2), ('Ranger', 'IPA', 70, 6.5),\
+                ('Two Women', 'Lager', 25, 5.0), ('Moon Man', 'IPA', 45, 5.0)]
+        for name, style, ibu, abv in rows:
+            db.session.add(Beer(name, 'New Belgium', ibu, 150, abv, style, 'USA'))
+        db.session.commit()
+        def names(url):
+            rv = self.app.get(url)
+            assert rv.status_code == 200
+            return [b['name'] for b in json.loads(rv.data)['results']]
+        assert names('/beer/api/v0.1/beers?abv_min=5.0&abv_max=5.5&sort_by=abv') ==\
+                ['Two Women', 'Moon Man', 'Fat Tire']
+        assert names('/beer/api/v0.1/beers?style=IPA&ibu_max=60') == ['Moon Man']
+        assert names('/beer/api/v0.1/beers?style=IPA&sort_by=ibu%20desc&limit=1') == ['Ranger']
+        assert self.app.get('/beer/api/v0.1/beers?abv_min=strong').status_code == 400
+        for value in ('nan', 'inf', '-Infinity'):
+            assert self.app.get('/beer/api/v0.1/beers?abv_min=' + value).status_code == 400
+        assert self.app.get('/beer/api/v0.1/users?sort_by=password').status_code == 400
+        assert self.app.get('/beer/api/v0.1/users?sort_by=email').status_code == 400
+        rv = self.app.get('/beer/api/v0.1/users?created_before=2000-01-01')
+        assert json.loads(rv.data)['results'] == []
+
+    # Leaderboards rank by the stored averages as reviews come and go
+    def test_top_beers(self):
+        for name in ('Fat Tire', 'Ranger', 'Two Women'):
+            db.session.add(Beer(name, 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        for i in range(3):
+            db.session.add(User('reviewer'+str(i), 'r{}@tests.local'.format(i), 'testing'))
+        db.session.commit()
+        def review(beer_id, author_id, taste):
+            data = {'aroma': 3, 'appearance': 3, 'taste': taste, 'palate': 3, 'bottle_style': 3}
+            db.session.add(Review(beer_id, author_id, data))
+            BeerScore.adjust(beer_id, data, count=1)
+            db.session.commit()
+        for author_id in (2, 3):
+            review(1, author_id, 6)
+            review(2, author_id, 8)
+        review(3, 2, 10)
+        review(1, 4, 9)
+        rv = self.app.get('/beer/api/v0.1/beers/top?category=taste&min_reviews=2')
+        top = json.loads(rv.data)['results']
+        assert [(b['name'], b['rank'], b['score']) for b in top] == [('Ranger', 1, 8.0),\
+                ('Fat Tire', 2, 7.0)]
+        rv = self.app.get('/beer/api/v0.1/beers/top?category=taste&min_reviews=1&n=1')
+        assert json.loads(rv.data)['results'][0]['name'] == 'Two Women'
+        assert BeerScore.rebuild() == []
+        assert self.app.get('/beer/api/v0.1/beers/top?category=flavor').status_code == 400
+
+    # Recommendations come from the offline model, refreshed with the reviews written since
+    def test_recommendations(self):
+        path = os.path.join(basedir, 'testing_recommendations.pickle')
+        app.config['RECOMMEND_MODEL_PATH'] = path
+        recommend.model = None
+        for name in ('Fat Tire', 'Ranger', 'Two Women', 'Sunshine'):
+            db.session.add(Beer(name, 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        for i in range(3):
+            db.session.add(User('reviewer'+str(i), 'r{}@tests.local'.format(i), 'testing'))
+        db.session.commit()
+        db.session.execute(favorite.insert(), [{'user_id': 2, 'beer_id': 1},\
+                {'user_id': 2, 'beer_id': 2}, {'user_id': 3, 'beer_id': 1},\
+                {'user_id': 3, 'beer_id': 2}, {'user_id': 3, 'beer_id': 4},\
+                {'user_id': 4, 'beer_id': 1}])
+        db.session.commit()
+        url = '/beer/api/v0.1/users/4/recommendations'
+        assert json.loads(self.app.get(url).data)['results'] == []
+        matrix = recommend.CooccurrenceMatrix.build(200)
+        matrix.model(50).save(path)
+        try:
+            names = [b['name'] for b in json.loads(self.app.get(url).data)['results']]
+            assert names == ['Ranger', 'Sunshine']
+            data = {'aroma': 5, 'appearance': 5, 'taste': 10, 'palate': 5, 'bottle_style': 5}
+            db.session.add(Review(3, 2, data))
+            db.session.commit()
+            # Requests don't fold reviews in, the refresh does
+            names = [b['name'] for b in json.loads(self.app.get(url).data)['results']]
+            assert names == ['Ranger', 'Sunshine']
+            assert recommend.refresh(matrix, path) == 1 and recommend.refresh(matrix, path) == 0
+            os.utime(path, (0, 0))
+            names = [b['name'] for b in json.loads(self.app.get(url).data)['results']]
+            assert names == ['Ranger', 'Two Women', 'Sunshine']
+            assert recommend.model.last_review_id == 1
+            assert self.app.get(url + '?n=0').status_code == 400
+            assert self.app.get('/beer/api/v0.1/users/99/recommendations').status_code == 404
+        finally:
+            os.remove(path)
+
+    def assert_same_matrix(self, matrix, fresh):
+        assert matrix.last_review_id == fresh.last_review_id
+        assert (matrix.pairs[0] == fresh.pairs[0]).all()
+        assert (matrix.pairs[2] == fresh.pairs[2]).all()
+        assert (abs(matrix.pairs[1] - fresh.pairs[1]) < 1e-9).all()
+        assert sorted(matrix.histories) == sorted(fresh.histories)
+        model, fresh = matrix.model(1), fresh.model(1)
+        for name in ('beer_ids', 'offsets', 'neighbor_ids'):
+            assert (getattr(model, name) == getattr(fresh, name)).all()
+        assert (abs(model.similarities - fresh.similarities) < 1e-9).all()
+
+    # Syncing reviews applies the history cap and neighbour pruning like a rebuild
+    def test_recommendations_sync(self):
+        for i in range(6):
+            db.session.add(Beer('Beer '+str(i), 'New Belgium', '4', '20', '4.60', 'Ale', 'USA'))
+        for i in range(3):
+            db.session.add(User('reviewer'+str(i), 'r{}@tests.local'.format(i), 'testing'))
+        db.session.commit()
+        db.session.execute(favorite.insert(), [{'user_id': 2, 'beer_id': 1},\
+                {'user_id': 2, 'beer_id': 2}, {'user_id': 3, 'beer_id': 2},\
+                {'user_id': 3, 'beer_id': 3}, {'user_id': 4, 'beer_id': 1},\
+                {'user_id': 4, 'beer_id': 4}])
+        db.session.commit()
+        def review(author_id, beer_id, taste):
+            data = {'aroma': 5, 'appearance': 5, 'taste': taste, 'palate': 5, 'bottle_style': 5}
+            db.session.add(Review(beer_id, author_id, data))
+            db.session.commit()
+        review(2, 3, 10)
+        matrix = recommend.CooccurrenceMatrix.build(2)
+        # New beers push older, weaker ones out of the authors' histories
+        review(2, 5, 20)
+        review(3, 6, 8)
+        review(2, 6, 18)
+        review(4, 5, 4)
+        assert matrix.sync(3) == 3 and matrix.sync(3) == 1
+        self.assert_same_matrix(matrix, recommend.CooccurrenceMatrix.build(2))
+        # The database caps a request's history like the build does
+        for user_id, vector in recommend.user_vectors().items():
+            ids, weights = recommend.user_history(user_id, 2)
+            expected = recommend.history(vector, 2)
+            assert (ids == expected[0]).all() and (abs(weights - expected[1]) < 1e-9).all()
+        model = matrix.model(1)
+        assert model.recommend(*recommend.history({1: 1.0}, 2), n=10)
+        assert model.recommend(*recommend.history({}, 2), n=10) == []
+
+    # Similar beers follow the catalog through the write routes
+    def test_similar_beers(self):
+        db.session.add(Beer('Pale', 'New Belgium', '40', '150', '5.0', 'Pale Ale', 'USA'))
+        db.session.add(Beer('Paler', 'New Belgium', '45', '160', '5.2', 'Pale Ale', 'USA'))
+        db.session.add(Beer('Strong', 'New Belgium', '80', '300', '9.0', 'IPA', 'USA'))
+        db.session.add(Beer('Light', 'New Belgium', '10', '100', '4.2', 'Lager', 'USA'))
+        db.session.commit()
+        def similar(id):
+            rv = self.app.get('/beer/api/v0.1/beers/{}/similar'.format(id))
+            return [(b['name'], b['distance']) for b in json.loads(rv.data)['results']]
+        assert [name for name, distance in similar(1)] == ['Paler', 'Light', 'Strong']
+        data = json.dumps({u'ibu': 40, u'calories': 150, u'abv': 5.0, u'style': 'Pale Ale'})
+        self.open_with_auth('/beer/api/v0.1/beers/3', 'PUT', data)
+        assert similar_index.version == beer_version()
+        assert similar(1)[0] == ('Strong', 0.0)
+        self.open_with_auth('/beer/api/v0.1/beers/3', 'DELETE', json.dumps({}))
+        data = json.dumps({u'name': 'Lighter', u'brewer': 'New Belgium', u'ibu': 8,\
+                u'calories': 90, u'abv': 4.0, u'style': 'Lager'})
+        self.open_with_auth('/beer/api/v0.1/beers', 'POST', data)
+        assert similar_index.version == beer_version()
+        assert [name for name, distance in similar(4)] == ['Lighter', 'Pale', 'Paler']
+        assert self.app.get('/beer/api/v0.1/beers/1/similar?n=x').status_code == 400
+        assert self.app.get('/beer/api/v0.1/beers/99/similar').status_code == 404
+
+    # Catalog statistics are aggregated from the tables and kept until they change
+    def test_stats(self):
+        computed.clear()
+        db.session.add(Beer('Pale', 'New Belgium', '40', '150', '5.0', 'Pale Ale', 'USA'))
+        db.session.add(Beer('Paler', 'New Belgium', '50', '160', '6.0', 'Pale Ale', 'USA'))
+        db.session.add(Beer('Light', 'New Belgium', None, '100', '4.0', 'Lager', 'USA'))
+        db.session.commit()
+        rv = self.app.get('/beer/api/v0.1/stats?bins=2')
+        stats = json.loads(rv.data)['results']
+        assert stats['beers']['count'] == 3
+        assert stats['beers']['abv']['percentiles']['50'] == 5.0
+        assert [b['count'] for b in stats['beers']['abv']['histogram']] == [1, 2]
+        assert stats['beers']['ibu']['count'] == 2 and stats['beers']['ibu']['mean'] == 45.0
+        assert [(s['style'], s['beers'], s['abv']) for s in stats['beers']['styles']] ==\
+                [('Lager', 1, 4.0), ('Pale Ale', 2, 5.5)]
+        assert stats['reviews']['count'] == 0
+        data = json.dumps({u'beer_id': 1, u'aroma': 4, u'appearance': 3, u'taste': 8,\
+                u'palate': 3, u'bottle_style': 2})
+        assert self.open_with_auth('/beer/api/v0.1/reviews', 'POST', data).status_code == 201
+        rv = self.app.get('/beer/api/v0.1/stats?bins=2')
+        stats = json.loads(rv.data)['results']
+        assert stats['reviews']['categories']['taste']['scores'][8] == 1
+        assert stats['reviews']['overall']['scores'][20] == 1
+        assert stats['beers']['styles'][1]['overall'] == 20.0
+        assert len(computed) == 1
+        assert self.app.get('/beer/api/v0.1/stats?bins=0').status_code == 400
+
+    # The catalog read model pages beers exactly like the database
+    def test_read_model(self):
+        path = os.path.join(basedir, 'testing_catalog.snapshot')
+        snapshot_path = app.config['READ_MODEL_SNAPSHOT_PATH']
+        app.config['READ_MODEL_SNAPSHOT_PATH'] = path
+        for i in range(12):
+            db.session.add(Beer('Beer {:02}'.format(i), 'Brewer {}'.format(i % 3),\
+                    None if i % 5 == 0 else str(20 + i % 4 * 10), str(100 + i),\
+                    str(4.0 + i % 6 * 0.5), ('Ale', 'Lager', None)[i % 3], 'USA'))
+        db.session.commit()
+        def pages(url):
+            results = []
+            while url:
+                rv = json.loads(self.app.get(url).data)
+                results.extend(rv['results'])
+                url = rv['next'] and rv['next'].replace('http://localhost', '')
+            return results
+        queries = ['limit=5', 'sort_by=abv&limit=4', 'sort_by=ibu%20desc&limit=3',\
+                'sort_by=style&limit=5', 'sort_by=name%20desc&abv_min=5&limit=2',\
+                'ibu_max=40&ibu_min=30&sort_by=calories&limit=2', 'brewer=Brewer%201',\
+                'abv_max=5.0&style=Ale&sort_by=ibu%20desc&limit=1']
+        def compare():
+            for query in queries:
+                url = '/beer/api/v0.1/beers?' + query
+                app.config['READ_MODEL_ENABLED'] = False
+                response_cache.reset()
+                expected = pages(url)
+                app.config['READ_MODEL_ENABLED'] = True
+                response_cache.reset()
+                assert pages(url) == expected, query
+        try:
+            compare()
+            # The first load is snapshotted for the next worker
+            assert catalog.version == beer_version() and os.path.exists(path)
+            data = json.dumps({u'ibu': 90, u'abv': 4.5, u'style': 'Lager'})
+            self.open_with_auth('/beer/api/v0.1/beers/3', 'PUT', data)
+            self.open_with_auth('/beer/api/v0.1/beers/5', 'DELETE', json.dumps({}))
+            assert catalog.version == beer_version()
+            compare()
+            # Writes applied in place wait for the next snapshot
+            restored = CatalogReadModel()
+            assert not restored.restore(path, beer_version())
+            assert catalog.snapshot() and not catalog.snapshot()
+            assert restored.restore(path, beer_version())
+            assert restored.indexes == catalog.indexes
+            loaded = CatalogReadModel()
+            loaded.load(beer_version())
+            assert loaded.indexes == catalog.indexes
+            # Another worker stores text in abv, then fixes it
+            for abv in ('strong', 6.5):
+                db.session.execute('UPDATE beer SET abv = :abv WHERE id = 4', {'abv': abv})
+                TableVersion.bump('beer')
+                db.session.commit()
+                compare()
+                assert catalog.version == beer_version()
+                assert catalog.exact == (abv != 'strong')
+        finally:
+            app.config['READ_MODEL_ENABLED'] = False
+            app.config['READ_MODEL_SNAPSHOT_PATH'] = snapshot_path
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Compiled schemas serialize objects and Core row tuples the same way
+    def test_schema_serializers(self):
+        g = Glass('Tulip')
+        db.session.add(g)
+        db.session.commit()
+        b = Beer('Fat Tire', 'New Belgium', '4', '20', '4.60', 'Amber Ale', 'USA')
+        b.glass_type_id = g.id
+        db.session.add(b)
+        db.session.commit()
+        data = {'aroma': 4, 'appearance': 3, 'taste': 8, 'palate': 3, 'bottle_style': 2}
+        db.session.add(Review(b.id, 1, data))
+        BeerScore.adjust(b.id, data, count=1)
+        db.session.commit()
+        with app.test_request_context():
+            beer = Beer.query.get(b.id)
+            review = Review.query.first()
+            assert beer.serialize()['glass_type'] == 'http://localhost/beer/api/v0.1/glasses/1'
+            assert beer.serialize()['average_scores']['taste'] == 8.0
+            assert review.serialize()['author'] == 'http://localhost/beer/api/v0.1/users/1'
+            assert review.serialize()['overall'] == 20
+            beers, scores = Beer.__table__, BeerScore.__table__
+            result = db.session.execute(select([beers, scores.c.review_count] +\
+                    [scores.c[c] for c in BeerScore.categories])\
+                    .select_from(beers.join(scores, scores.c.beer_id == beers.c.id)))
+            assert Beer.schema.serialize_all(result.fetchall(), result.keys()) ==\
+                    [beer.serialize()]
+            result = db.session.execute(Review.__table__.select())
+            assert Review.schema.serialize_all(result.fetchall(), result.keys()) ==\
+                    [review.serialize()]
+            assert Glass.serialize_all([g])[0]['beers'] == [beer.serialize()]
+
 
 if __name__ == '__main__':
     unittest.main()